@@ -0,0 +1,102 @@
+"""Benchmark of the memory used per node of a synthetic model.
+
+Builds a model with the core API (agents with sites, flags, attributes and
+phosphorylations between them) and reports the bytes owned by each node:
+the object itself plus any dicts, lists and sets belonging only to it.
+Strings and child nodes are not counted.
+
+The same model is also built in a columnar.ColumnarGraph, for which the
+bytes per node are those of its arrays, dicts and lists (again not counting
+strings).
+
+Usage: python bench_memory.py [num_agents]
+"""
+import os
+import sys
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'pykami'))
+
+from core import *
+from columnar import ColumnarGraph
+
+def build_model(num_agents):
+    """Build a synthetic model and return the list of all of its nodes."""
+    nodes = []
+    agents = [Agent('A%d' % i) for i in range(num_agents)]
+    for i, agent in enumerate(agents):
+        nodes.append(agent)
+        for j in range(3):
+            site = agent.get_create_site('S%d' % (100 + j))
+            flag = site.get_create_flag('phos')
+            enz = agents[(i + j + 1) % num_agents]
+            phos = Phosphorylation(enz, flag)
+            flag.add_formula_term(str(phos.id))
+            nodes += [site, flag, phos]
+        attr = agent.get_create_attribute('Kinase_active')
+        attr.add_formula_term('%s.S100.phos' % agent.name)
+        nodes.append(attr)
+        nodes.append(Bind(agent, agents[(i + 1) % num_agents]))
+    return nodes
+
+def build_columnar_model(num_agents):
+    """Build the synthetic model in a ColumnarGraph."""
+    graph = ColumnarGraph()
+    agents = [graph.get_create_agent('A%d' % i) for i in range(num_agents)]
+    for i, agent in enumerate(agents):
+        for j in range(3):
+            site = agent.get_create_site('S%d' % (100 + j))
+            flag = site.get_create_flag('phos')
+            enz = agents[(i + j + 1) % num_agents]
+            phos = graph.add_phosphorylation(enz, flag)
+            flag.add_formula_term(str(phos.id))
+        attr = agent.get_create_attribute('Kinase_active')
+        attr.add_formula_term('%s.S100.phos' % agent.name)
+        graph.add_bind(agent, agents[(i + 1) % num_agents])
+    return graph
+
+def columnar_size(graph):
+    """Return the bytes of the containers of a ColumnarGraph."""
+    size = 0
+    for value in graph.__dict__.values():
+        size += sys.getsizeof(value)
+        if type(value) is dict:
+            for item in value.values():
+                if type(item) in (list, set):
+                    size += sys.getsizeof(item)
+    return size
+
+def owned_size(obj):
+    """Return the bytes of the object and the containers only it refers to.
+    """
+    size = sys.getsizeof(obj)
+    values = []
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+        values += obj.__dict__.values()
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                values.append(getattr(obj, slot))
+    for value in values:
+        if type(value) in (dict, list, set):
+            size += sys.getsizeof(value)
+    return size
+
+if __name__ == '__main__':
+    num_agents = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    nodes = build_model(num_agents)
+    sizes = collections.defaultdict(list)
+    for node in nodes:
+        sizes[type(node).__name__].append(owned_size(node))
+    total = 0
+    print 'Bytes per node (%d nodes):' % len(nodes)
+    for node_type, type_sizes in sorted(sizes.items()):
+        total += sum(type_sizes)
+        print '  %-16s %6.1f' % (node_type,
+                                 sum(type_sizes) / float(len(type_sizes)))
+    print '  %-16s %6.1f' % ('all', total / float(len(nodes)))
+    graph = build_columnar_model(num_agents)
+    print '  %-16s %6.1f' % ('columnar', columnar_size(graph) /
+                                         float(len(graph)))
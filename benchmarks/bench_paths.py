@@ -0,0 +1,48 @@
+"""Benchmark of nodes_to_kami with cached paths vs. parent-chain walks.
+
+Usage: python bench_paths.py [repeat]
+"""
+import sys
+import timeit
+
+from corpus import load_neighborhood
+import indra_to_kami
+from indra_to_kami import IndraKamiConverter, convert_statements, \
+                          nodes_to_kami
+
+def walk_path(source):
+    """Get the path by walking the parent chain, as before path caching."""
+    sub_source = source
+    source_path = []
+    while True:
+        source_path.append(sub_source.id)
+        if sub_source.parent:
+            sub_source = sub_source.parent
+        else:
+            break
+    source_path.reverse()
+    return source_path
+
+def time_export(nodes, repeat):
+    """Return the best time for exporting the nodes, in seconds."""
+    # Warm up before timing
+    nodes_to_kami(nodes)
+    return min(timeit.repeat(lambda: nodes_to_kami(nodes),
+                             number=1, repeat=repeat))
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    nodes = convert_statements(load_neighborhood(), IndraKamiConverter())
+
+    cached = time_export(nodes, repeat)
+    get_path = indra_to_kami.get_path
+    indra_to_kami.get_path = walk_path
+    try:
+        walked = time_export(nodes, repeat)
+    finally:
+        indra_to_kami.get_path = get_path
+
+    print 'nodes_to_kami on %d nodes (best of %d):' % (len(nodes), repeat)
+    print '  parent-chain walk: %.3f ms' % (walked * 1000)
+    print '  cached paths:      %.3f ms' % (cached * 1000)
+    print '  speedup:           %.2fx' % (walked / cached)
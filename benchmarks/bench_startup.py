@@ -0,0 +1,87 @@
+"""Benchmark of the startup time of short conversion jobs.
+
+Runs each of the following in a new interpreter, repeatedly, and reports
+the best wall time of each:
+
+- python: starting the interpreter alone
+- import: importing indra_to_kami
+- convert: converting a pickle of the bundled RAS/RAF neighborhood into
+  Kami JSON with the command line of indra_to_kami (see indra_to_kami.main)
+
+It also lists the heavy modules (pygraphviz, INDRA and sqlite3, used by the
+conversion cache and the disk registry) loaded by the import and by the
+conversion: the import should load none of them, and the conversion only the
+INDRA statement classes, needed to read the statements.
+
+Usage: python bench_startup.py [repeat]
+"""
+import os
+import sys
+import time
+import shutil
+import pickle
+import tempfile
+import subprocess
+
+from corpus import pykami_dir, load_neighborhood
+
+# The top-level packages of the heavy modules
+heavy_modules = ('pygraphviz', 'indra', 'sqlite3')
+
+# Prints the heavy modules loaded by the code run before it
+list_modules = ('import sys; print "\\n".join(sorted(m for m in sys.modules '
+                'if m.split(".")[0] in %r and sys.modules[m] is not None))' %
+                (heavy_modules,))
+
+def best_time(args, repeat):
+    """Return the best wall time of running the command, in seconds."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, cwd=pykami_dir)
+            times.append(time.time() - start)
+    return min(times)
+
+def loaded_modules(code):
+    """Return the heavy modules loaded by running the Python code."""
+    output = subprocess.check_output([sys.executable, '-c',
+                                      code + '; ' + list_modules],
+                                     cwd=pykami_dir)
+    return output.split()
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Statements of types no longer in INDRA are left out, as they can
+        # only be loaded with the corpus module
+        stmts_file = os.path.join(tmp_dir, 'statements.pck')
+        with open(stmts_file, 'wb') as f:
+            pickle.dump([stmt for stmt in load_neighborhood()
+                         if type(stmt).__module__ == 'indra.statements'],
+                        f, pickle.HIGHEST_PROTOCOL)
+        kami_file = os.path.join(tmp_dir, 'kami.json')
+        convert_args = ['-o', kami_file, stmts_file]
+
+        python = best_time([sys.executable, '-c', 'pass'], repeat)
+        imported = best_time([sys.executable, '-c', 'import indra_to_kami'],
+                             repeat)
+        converted = best_time([sys.executable, 'indra_to_kami.py'] +
+                              convert_args, repeat)
+        import_modules = loaded_modules('import indra_to_kami')
+        convert_modules = loaded_modules('import indra_to_kami; '
+                                         'indra_to_kami.main(%r)' %
+                                         convert_args)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print 'Startup times (best of %d):' % repeat
+    print '  python:  %8.1f ms' % (python * 1000)
+    print '  import:  %8.1f ms (+%.1f ms)' % (imported * 1000,
+                                              (imported - python) * 1000)
+    print '  convert: %8.1f ms (+%.1f ms)' % (converted * 1000,
+                                              (converted - python) * 1000)
+    print 'Heavy modules loaded:'
+    print '  import:  %s' % (', '.join(import_modules) or 'none')
+    print '  convert: %s' % (', '.join(convert_modules) or 'none')
@@ -0,0 +1,102 @@
+"""Statement corpora for the pykami benchmarks."""
+import os
+import sys
+import copy
+import math
+import bisect
+import pickle
+import random
+
+# The pykami modules use implicit relative imports, so the package directory
+# itself has to be on the path
+pykami_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'pykami')
+sys.path.insert(0, pykami_dir)
+
+import indra.statements
+
+neighborhood_file = os.path.join(pykami_dir, 'RAS_RAF_neighborhood.pck')
+
+class _BelpyUnpickler(pickle.Unpickler):
+    """Unpickler loading belpy statements as the INDRA statements.
+
+    Statement types that no longer exist in INDRA are loaded as instances of
+    placeholder classes, which the converter ignores.
+    """
+    placeholders = {}
+
+    def find_class(self, module, name):
+        if module != 'belpy.statements':
+            return pickle.Unpickler.find_class(self, module, name)
+        try:
+            return getattr(indra.statements, name)
+        except AttributeError:
+            return self.placeholders.setdefault(name,
+                                                type(name, (object,), {}))
+
+def load_neighborhood(filename=neighborhood_file):
+    """Load the bundled RAS/RAF neighborhood as a list of INDRA statements.
+
+    The pickle was written by belpy, the predecessor of INDRA, whose
+    statements refer to their agents by name (enz_name, sub_name,
+    monomer_name) and have a single modification per ActivityModification.
+    The fields used by IndraKamiConverter are filled in from these.
+    """
+    with open(filename, 'rb') as f:
+        stmts = _BelpyUnpickler(f).load()
+    for stmt in stmts:
+        if isinstance(stmt, indra.statements.Phosphorylation):
+            stmt.enz = indra.statements.Agent(stmt.enz_name)
+            stmt.sub = indra.statements.Agent(stmt.sub_name)
+        elif isinstance(stmt, indra.statements.ActivityModification):
+            stmt.monomer = indra.statements.Agent(stmt.monomer_name)
+            stmt.mod = [stmt.mod]
+            if stmt.mod_pos is not None:
+                stmt.mod_pos = [stmt.mod_pos]
+            stmt.relationship = stmt.relationship[0].lower() + \
+                                stmt.relationship[1:]
+    return stmts
+
+def _agent_fields(stmt):
+    """Return the names of the agent fields used by the converter."""
+    if isinstance(stmt, indra.statements.Phosphorylation):
+        return ['enz', 'sub']
+    elif isinstance(stmt, indra.statements.ActivityModification):
+        return ['monomer']
+    return []
+
+def synthesize(stmts, scale, seed=0):
+    """Return a corpus scale times larger than the given statements.
+
+    Each synthetic statement is a copy of one of the given statements with
+    its agents renamed. The names are drawn from a pool that grows with the
+    square root of the scale, with Zipf-distributed frequencies, so that
+    (as in real corpora) a few hub agents take part in many statements and
+    most agents in only a few. The original agent names are the most
+    frequent ones in the pool.
+    """
+    rng = random.Random(seed)
+    names = []
+    for stmt in stmts:
+        for field in _agent_fields(stmt):
+            name = getattr(stmt, field).name
+            if name not in names:
+                names.append(name)
+    pool_size = int(len(names) * math.sqrt(scale))
+    names += ['SYN%d' % i for i in range(pool_size - len(names))]
+    # Cumulative Zipf weights for sampling the names
+    cum_weights = []
+    total = 0.
+    for rank in range(1, len(names) + 1):
+        total += 1. / rank
+        cum_weights.append(total)
+
+    synthetic = []
+    for i in range(scale):
+        for stmt in stmts:
+            new_stmt = copy.copy(stmt)
+            for field in _agent_fields(stmt):
+                index = bisect.bisect(cum_weights, rng.random() * total)
+                setattr(new_stmt, field, indra.statements.Agent(names[index]))
+            synthetic.append(new_stmt)
+    return synthetic
@@ -0,0 +1,152 @@
+"""Benchmark suite for conversion, export and rendering.
+
+Times each stage of the pipeline, and measures the peak memory it uses, on
+the bundled RAS/RAF neighborhood and on synthetic corpora scaled up from it
+(see corpus.synthesize). The stages are:
+
+- ingest: converting the statements with IndraKamiConverter
+- export: building the Kami JSON dict with nodes_to_kami
+- serialize: serializing the Kami JSON dict with json.dumps
+- render: rendering the pygraphviz graph with Graph.render
+- write: writing the DOT file with Graph.write
+
+Each stage is run in a forked process so that its peak memory can be
+measured separately; the peak is reported as the increase of the maximum
+resident set size over the resident set size at the start of the stage.
+
+A stage that fails (e.g., rendering without pygraphviz installed) is
+reported with its error instead of its time and memory, and the stages
+depending on it are skipped.
+
+The results are written as JSON to the output file (bench_results.json by
+default), for comparison between runs.
+
+Usage: python run_benchmarks.py [-o output] [-s scale,scale,...]
+                                [--no-render]
+"""
+import os
+import json
+import time
+import Queue
+import shutil
+import resource
+import tempfile
+import platform
+import optparse
+import multiprocessing
+
+from corpus import load_neighborhood, synthesize
+from indra_to_kami import IndraKamiConverter, convert_statements, \
+                          nodes_to_kami
+from core import Graph
+
+def _current_rss_kb():
+    """Return the current resident set size of the process in kilobytes."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+def _run_stage(func, args, kwargs, queue):
+    rss_start = _current_rss_kb()
+    start = time.time()
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        queue.put({'error': '%s: %s' % (type(e).__name__, e)})
+        return
+    seconds = time.time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+    queue.put({'seconds': seconds, 'peak_memory_kb': max(peak_kb, 0)})
+
+def time_stage(func, *args, **kwargs):
+    """Run func(*args, **kwargs) in a forked process, returning its time and
+    memory, or the error with which it failed."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage,
+                                      args=(func, args, kwargs, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=0.1)
+            break
+        except Queue.Empty:
+            # The process may have died without reporting (e.g., killed
+            # when out of memory); what it put is on the queue once it has
+            # exited
+            if process.exitcode is not None:
+                try:
+                    result = queue.get_nowait()
+                except Queue.Empty:
+                    result = {'error': 'Exited with code %d' %
+                                       process.exitcode}
+                break
+    process.join()
+    return result
+
+def benchmark_corpus(corpus, scale, stmts, render=True):
+    """Run all of the stages on the statements, returning the results."""
+    results = []
+
+    def add_result(stage, result, **extra):
+        result.update({'corpus': corpus, 'scale': scale,
+                       'statements': len(stmts), 'stage': stage})
+        result.update(extra)
+        results.append(result)
+
+    add_result('ingest',
+               time_stage(convert_statements, stmts, IndraKamiConverter()))
+    # The later stages need the converted nodes in this process
+    nodes = convert_statements(stmts, IndraKamiConverter())
+    add_result('export', time_stage(nodes_to_kami, nodes), nodes=len(nodes))
+    output = nodes_to_kami(nodes)
+    add_result('serialize', time_stage(json.dumps, output, indent=2))
+    del output
+    if render:
+        directory = tempfile.mkdtemp()
+        try:
+            kg = Graph(os.path.join(directory, 'bench'), nodes)
+            rendered = time_stage(kg.render)
+            add_result('render', rendered)
+            # Writing needs the rendered graph
+            if 'error' not in rendered:
+                kg.render()
+                add_result('write', time_stage(kg.write))
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='python %prog [options]')
+    parser.add_option('-o', '--output', default='bench_results.json',
+                      help='file to write the results to')
+    parser.add_option('-s', '--scales', default='10,100,1000',
+                      help='comma-separated scale factors of the synthetic '
+                           'corpora')
+    parser.add_option('--no-render', dest='render', action='store_false',
+                      default=True, help='skip the rendering stages')
+    options, args = parser.parse_args()
+
+    neighborhood = load_neighborhood()
+    corpora = [('neighborhood', 1, neighborhood)]
+    for scale in options.scales.split(','):
+        if scale:
+            corpora.append(('synthetic', int(scale),
+                            synthesize(neighborhood, int(scale))))
+
+    results = []
+    for corpus, scale, stmts in corpora:
+        for result in benchmark_corpus(corpus, scale, stmts, options.render):
+            if 'error' in result:
+                print '%-12s %6dx %-10s failed: %s' % \
+                      (corpus, scale, result['stage'], result['error'])
+            else:
+                print '%-12s %6dx %-10s %10.4f s %10d kB' % \
+                      (corpus, scale, result['stage'], result['seconds'],
+                       result['peak_memory_kb'])
+            results.append(result)
+
+    with open(options.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'results': results}, f, indent=2)
@@ -0,0 +1,351 @@
+"""Disk-backed registry of agents, for models that do not fit in memory.
+
+A DiskAgentRegistry stands in for the nodes_dict, relationships and nodes
+set of an IndraKamiConverter (see its registry parameter). The agents are
+kept in an SQLite database, each pickled together with the nodes it contains
+(sites, key residues, flags and attributes), and only the most recently used
+agents are kept in memory, in an LRU cache. Relationships are not kept in
+memory at all: each is stored as a row giving its ID, its type and
+references to its endpoints (the agent name and the path of names down to
+the endpoint), and is rebuilt, with its endpoints looked up in the
+registry, when read back.
+
+The cache may grow beyond its size while a statement is converted (or a
+shard merged), and is trimmed back to it by trim, which the converter calls
+between statements. Trimming writes the agents that changed since they were
+loaded back to the database and drops them from memory, so nodes obtained
+from the registry must not be modified after the next trim: they may no
+longer be the nodes of the model, which are loaded anew from the database.
+For the same reason, relationships are not indexed by their endpoints (the
+converter detaches them, see Node.relationships).
+
+Iterating over the nodes collection reads the whole model back, one agent
+at a time, so that it can be exported in bounded memory with write_kami.
+
+A registry can be reopened to add to the model stored in it: the ID counter
+(core.id_counter) is stored along with the model when it is flushed, and
+restored when the registry is opened, so that the nodes created afterwards
+do not reuse the IDs of the stored ones.
+"""
+import json
+import sqlite3
+import cPickle
+import cStringIO
+import collections
+import core
+from core import *
+
+# The attribute holding the children of each type of node, by type name
+child_attributes = {'Site': 'sites', 'KeyResidue': 'key_residues',
+                    'Flag': 'flags', 'Attribute': 'attributes'}
+
+# The types of relationships that can be stored, by name
+relationship_classes = {'Phosphorylation': Phosphorylation, 'Bind': Bind}
+
+# The number of rows read from the database at a time while iterating
+chunk_size = 1000
+
+def node_reference(node):
+    """Return a reference to a node: the name of its agent, followed by the
+    [type name, name] pairs of the nodes down to it."""
+    path = []
+    while node.parent is not None:
+        path.append([type(node).__name__, node.name])
+        node = node.parent
+    path.append(node.name)
+    path.reverse()
+    return path
+
+def _persistent_id(obj):
+    # Relationships indexed by the nodes of an agent are not pickled with it
+    if isinstance(obj, Relationship):
+        return 'relationship'
+    return None
+
+def _persistent_load(pid):
+    return None
+
+def dump_agent(agent):
+    """Pickle an agent with the nodes it contains, but not the relationships
+    indexed by them."""
+    f = cStringIO.StringIO()
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    # Only called for objects of types other than the built-in ones
+    pickler.inst_persistent_id = _persistent_id
+    pickler.dump(agent)
+    return f.getvalue()
+
+def load_agent(data):
+    """Unpickle an agent pickled with dump_agent."""
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = _persistent_load
+    agent = unpickler.load()
+    for node in [agent] + agent.descendants():
+        node._relationships = None
+    return agent
+
+
+class DiskAgentRegistry(object):
+    """Agents by name, stored on disk with an LRU cache of the hot agents.
+
+    Supports the dict operations used by IndraKamiConverter on its
+    nodes_dict: registry[name], registry[name] = agent, name in registry and
+    len(registry).
+
+    Parameters
+    ----------
+    filename : string
+        The name of the database file. If it exists, the model stored in it
+        is kept and added to. By default, a temporary database is used,
+        which is deleted when closed.
+    cache_size : int
+        The number of agents kept in memory after each trim.
+
+    Attributes
+    ----------
+    relationships : RegistryRelationships
+        The relationships, by ID.
+    nodes : RegistryNodes
+        The collection of all of the nodes: the agents, the nodes they
+        contain and the relationships.
+    """
+    def __init__(self, filename='', cache_size=10000):
+        self.cache_size = cache_size
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = str
+        self.connection.execute('CREATE TABLE IF NOT EXISTS agents '
+                                '(name TEXT PRIMARY KEY, data BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS relationships '
+                                '(seq INTEGER PRIMARY KEY, id TEXT UNIQUE, '
+                                'type TEXT, endpoints TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                                '(key TEXT PRIMARY KEY, value INTEGER)')
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?',
+                                      ('id_counter',)).fetchone()
+        if row is not None:
+            core.id_counter = max(core.id_counter, row[0])
+        # The cached agents, least recently used first, and the version of
+        # each when it was loaded or last written (None if never written)
+        self._cache = collections.OrderedDict()
+        self._versions = {}
+        self.relationships = RegistryRelationships(self)
+        self.nodes = RegistryNodes(self)
+
+    def __contains__(self, name):
+        if name in self._cache:
+            return True
+        return self.connection.execute('SELECT 1 FROM agents WHERE name = ?',
+                                       (name,)).fetchone() is not None
+
+    def __getitem__(self, name):
+        agent = self._cache.pop(name, None)
+        if agent is None:
+            row = self.connection.execute('SELECT data FROM agents '
+                                          'WHERE name = ?',
+                                          (name,)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            agent = load_agent(str(row[0]))
+            self._versions[name] = agent.version
+        self._cache[name] = agent
+        return agent
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name, agent):
+        self._cache.pop(name, None)
+        self._cache[name] = agent
+        self._versions[name] = None
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute(
+                                'SELECT COUNT(*) FROM agents').fetchone()[0]
+
+    def names(self):
+        """Generate the names of the agents, in the order in which they were
+        first written to the database."""
+        self.flush()
+        last = 0
+        while True:
+            rows = self.connection.execute('SELECT rowid, name FROM agents '
+                                           'WHERE rowid > ? ORDER BY rowid '
+                                           'LIMIT ?',
+                                           (last, chunk_size)).fetchall()
+            if not rows:
+                return
+            for last, name in rows:
+                yield name
+
+    def _write(self, name, agent):
+        """Write an agent to the database if it changed."""
+        if self._versions.get(name) == agent.version:
+            return
+        data = sqlite3.Binary(dump_agent(agent))
+        # Existing rows are updated in place, keeping their order
+        cursor = self.connection.execute('UPDATE agents SET data = ? '
+                                         'WHERE name = ?', (data, name))
+        if cursor.rowcount == 0:
+            self.connection.execute('INSERT INTO agents VALUES (?, ?)',
+                                    (name, data))
+        self._versions[name] = agent.version
+
+    def trim(self):
+        """Evict the least recently used agents beyond cache_size, writing
+        those that changed to the database."""
+        while len(self._cache) > self.cache_size:
+            name, agent = self._cache.popitem(last=False)
+            self._write(name, agent)
+            del self._versions[name]
+
+    def flush(self):
+        """Write the cached agents that changed and the ID counter, and
+        commit."""
+        for name, agent in self._cache.iteritems():
+            self._write(name, agent)
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                ('id_counter', core.id_counter))
+        self.connection.commit()
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.connection.close()
+
+    def node(self, reference):
+        """Return the node with the reference (see node_reference)."""
+        node = self[reference[0]]
+        for type_name, name in reference[1:]:
+            node = getattr(node, child_attributes[type_name])[name]
+        return node
+
+
+class RegistryRelationships(object):
+    """The relationships of a DiskAgentRegistry, by ID.
+
+    Supports the dict operations used by IndraKamiConverter on its
+    relationships dict. The relationships returned are rebuilt from the
+    database, with their endpoints looked up in the registry, and are not
+    indexed by their endpoints.
+    """
+    def __init__(self, registry):
+        self.registry = registry
+        self.connection = registry.connection
+
+    def _relationship(self, rel_id, type_name, endpoints):
+        cls = relationship_classes[type_name]
+        nodes = [self.registry.node(reference)
+                 for reference in json.loads(endpoints)]
+        # The slots are set without indexing the relationship in its
+        # endpoints, as Relationship.__setstate__ would
+        rel = cls.__new__(cls)
+        if issubclass(cls, DirectedBinary):
+            Slotted.__setstate__(rel, {'id': rel_id, 'source': nodes[0],
+                                       'target': nodes[1]})
+        else:
+            Slotted.__setstate__(rel, {'id': rel_id, 'node_list': nodes})
+        return rel
+
+    def __contains__(self, rel_id):
+        return self.connection.execute('SELECT 1 FROM relationships '
+                                       'WHERE id = ?',
+                                       (str(rel_id),)).fetchone() is not None
+
+    def __getitem__(self, rel_id):
+        row = self.connection.execute('SELECT id, type, endpoints FROM '
+                                      'relationships WHERE id = ?',
+                                      (str(rel_id),)).fetchone()
+        if row is None:
+            raise KeyError(rel_id)
+        return self._relationship(*row)
+
+    def get(self, rel_id, default=None):
+        try:
+            return self[rel_id]
+        except KeyError:
+            return default
+
+    def setdefault(self, rel_id, rel):
+        """Store the relationship unless there is one with the ID already,
+        and return the stored relationship."""
+        cursor = self.connection.execute(
+                        'INSERT OR IGNORE INTO relationships '
+                        '(id, type, endpoints) VALUES (?, ?, ?)',
+                        (str(rel_id), type(rel).__name__,
+                         json.dumps([node_reference(node)
+                                     for node in rel.endpoints()])))
+        if cursor.rowcount:
+            return rel
+        return self[rel_id]
+
+    def __len__(self):
+        return self.connection.execute(
+                        'SELECT COUNT(*) FROM relationships').fetchone()[0]
+
+    def itervalues(self):
+        """Generate the relationships, in the order in which they were
+        stored."""
+        last = 0
+        while True:
+            rows = self.connection.execute('SELECT seq, id, type, endpoints '
+                                           'FROM relationships '
+                                           'WHERE seq > ? ORDER BY seq '
+                                           'LIMIT ?',
+                                           (last, chunk_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                last = row[0]
+                yield self._relationship(*row[1:])
+                self.registry.trim()
+
+
+class RegistryNodes(object):
+    """The collection of the nodes of a DiskAgentRegistry.
+
+    Supports the set operations used by IndraKamiConverter on its nodes set.
+    The nodes contained in the registered agents are members of the
+    collection along with the agents, so only agents and relationships need
+    to be added.
+
+    Iterating over the collection generates each agent followed by the nodes
+    it contains, and then the relationships, loading them from the database
+    as it goes.
+    """
+    # The maximum number of contexts kept while exporting (see
+    # KamiRecordBuilder), so that exports run in bounded memory
+    max_contexts = 10000
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __contains__(self, node):
+        if isinstance(node, Relationship):
+            return node.id in self.registry.relationships
+        while node.parent is not None:
+            node = node.parent
+        return node.name in self.registry
+
+    def add(self, node):
+        if isinstance(node, Relationship):
+            self.registry.relationships.setdefault(node.id, node)
+        elif isinstance(node, Agent):
+            if node.name not in self.registry:
+                self.registry[node.name] = node
+
+    def __len__(self):
+        return sum(1 for node in self)
+
+    def __iter__(self):
+        for name in self.registry.names():
+            agent = self.registry[name]
+            yield agent
+            for node in agent.descendants():
+                yield node
+            self.registry.trim()
+        for rel in self.registry.relationships.itervalues():
+            yield rel
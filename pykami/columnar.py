@@ -0,0 +1,596 @@
+"""Columnar storage of Kami models in flat arrays.
+
+A ColumnarGraph stores the nodes of a model as rows of a few flat arrays
+("columns") rather than as a tree of node objects: the type of each node,
+the row of its parent, the index of its name in a table of distinct names,
+and its ID. The endpoints of relationships are stored as pairs of rows, and
+formulas as lists of indices into the name table. This takes a little over
+half of the memory of the object tree of core (see
+benchmarks/bench_memory.py), and the exporters to Kami JSON and DOT process
+the model a column at a time.
+
+The object API is available through ColumnarNode, a lightweight view of a
+row with the interface of the core nodes (get_create_site, flags,
+add_formula_term, etc.), so that an IndraKamiConverter can build its model
+in a ColumnarGraph (see IndraKamiConverter.store). Collections of views can
+be exported to Kami JSON with the functions of indra_to_kami, but not
+rendered with core.Graph: the DOT file of a ColumnarGraph is written with
+its write_dot method.
+"""
+import array
+import bisect
+import instrumentation
+from core import get_id, edge_style, DotWriter, Agent, Site, KeyResidue, \
+                 Flag, Attribute, Relationship, Phosphorylation, Bind
+
+# Codes of the types of nodes, stored in the types column
+AGENT, SITE, KEY_RESIDUE, FLAG, ATTRIBUTE, PHOSPHORYLATION, BIND = range(7)
+
+type_names = ['Agent', 'Site', 'KeyResidue', 'Flag', 'Attribute',
+              'Phosphorylation', 'Bind']
+
+# Kami classes of the nodes, and the labels of the edges to them from their
+# parents in the DOT output
+kami_classes = {AGENT: 'agent', SITE: 'region', KEY_RESIDUE: 'key_r',
+                FLAG: 'flag', ATTRIBUTE: 'attr'}
+child_labels = {SITE: 'site', KEY_RESIDUE: 'kr', FLAG: 'flag',
+                ATTRIBUTE: 'attr'}
+
+# The styles used by the render methods of the core nodes
+styles = {AGENT: {'color': 'lightgrey', 'style': 'filled',
+                  'fontname': 'arial'},
+          SITE: {'color': 'red', 'style': 'filled', 'fontname': 'arial'},
+          KEY_RESIDUE: {'color': 'green', 'style': 'filled',
+                        'fontname': 'arial'},
+          FLAG: Flag.style,
+          ATTRIBUTE: Attribute.style,
+          PHOSPHORYLATION: Relationship.style,
+          BIND: Relationship.style}
+
+formula_separators = {FLAG: Flag.formula_separator,
+                      ATTRIBUTE: Attribute.formula_separator}
+
+# Prefixes of the IDs of relationships
+id_prefixes = {PHOSPHORYLATION: Phosphorylation.name, BIND: Bind.name}
+
+# The core classes of the node types; subclasses come before their parents
+core_classes = [(Agent, AGENT), (Site, SITE), (KeyResidue, KEY_RESIDUE),
+                (Attribute, ATTRIBUTE), (Flag, FLAG),
+                (Phosphorylation, PHOSPHORYLATION), (Bind, BIND)]
+
+def type_code(node):
+    """Return the type code of a core node or ColumnarNode."""
+    if isinstance(node, ColumnarNode):
+        return node.node_type
+    for cls, code in core_classes:
+        if isinstance(node, cls):
+            return code
+    raise ValueError('Node %s has no type code' % node)
+
+
+class ColumnarGraph(object):
+    """A Kami model stored in flat arrays, with one row per node.
+
+    Rows are only ever appended, and a parent is always added before its
+    children, so every node comes after its ancestors. IDs are assigned with
+    core.get_id as the rows are added, so they are sequential (stable IDs
+    are not used) and shared with any core nodes created at the same time.
+
+    Attributes
+    ----------
+    types : array.array
+        The type code of each node (AGENT, SITE, ..., BIND).
+    parents : array.array
+        The row of the parent of each node, or -1 for agents and
+        relationships.
+    names : array.array
+        The index of the name of each node in the strings table, or -1 for
+        relationships.
+    ids : array.array
+        The numeric ID of each node (relationship IDs are prefixed with
+        'p' or 'b', see node_id).
+    strings : list of string
+        The table of distinct names and formula terms.
+    edge_relationships, edge_nodes : array.array
+        The endpoints of the relationships, as pairs of the row of the
+        relationship and the row of the node. The source of a
+        Phosphorylation comes before its target. The pairs are in order of
+        the rows of the relationships, so that the endpoints of each are
+        found by binary search.
+    formulas : dict
+        Maps the row of each flag or attribute with a formula to the list of
+        the indices of its terms in the strings table.
+    """
+    def __init__(self):
+        self.types = array.array('b')
+        self.parents = array.array('l')
+        self.names = array.array('l')
+        self.ids = array.array('l')
+        # The first child and next sibling of each node, linking the
+        # children of each node in a list (-1 at the end)
+        self.first_children = array.array('l')
+        self.next_siblings = array.array('l')
+        self.strings = []
+        self.edge_relationships = array.array('l')
+        self.edge_nodes = array.array('l')
+        self.formulas = {}
+        # The index of each string in the strings table
+        self._string_index = {}
+        # The row of each component, flag and attribute, by the row of its
+        # parent, its type and the index of its name (see _key)
+        self._rows = {}
+        # The (row, term index) pairs of the formulas, for deduplication
+        self._formula_keys = set([])
+
+    def __len__(self):
+        return len(self.types)
+
+    def intern(self, string):
+        """Return the index of the string in the strings table, adding it if
+        necessary."""
+        index = self._string_index.get(string)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(string)
+            self._string_index[string] = index
+        return index
+
+    def _add_row(self, node_type, parent, name):
+        row = len(self.types)
+        self.types.append(node_type)
+        self.parents.append(parent)
+        self.names.append(name)
+        self.ids.append(get_id())
+        self.first_children.append(-1)
+        self.next_siblings.append(-1)
+        if parent >= 0:
+            # Link the node at the head of the list of children
+            self.next_siblings[row] = self.first_children[parent]
+            self.first_children[parent] = row
+        if instrumentation.hook is not None:
+            instrumentation.hook('count', 'nodes.' + type_names[node_type], 1)
+        return row
+
+    def _key(self, a, b, c=0):
+        """Pack a tuple of small integers into a single integer key, which
+        takes much less memory than the tuple in a dict or set."""
+        return (((a + 1) << 40) | (b << 3)) | c
+
+    def get_create(self, node_type, parent, name):
+        """Return the row of the named node of the given type and parent,
+        adding it if necessary.
+
+        Parameters
+        ----------
+        node_type : int
+            The type code of the node (AGENT, SITE, KEY_RESIDUE, FLAG or
+            ATTRIBUTE).
+        parent : int
+            The row of the parent, or -1 for agents.
+        name : string
+            The name of the node.
+        """
+        name = self.intern(name)
+        key = self._key(parent, name, node_type)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._add_row(node_type, parent, name)
+            self._rows[key] = row
+        return row
+
+    def add_relationship(self, node_type, endpoints):
+        """Add a relationship between the nodes in the given rows, returning
+        its row."""
+        row = self._add_row(node_type, -1, -1)
+        for endpoint in endpoints:
+            self.edge_relationships.append(row)
+            self.edge_nodes.append(endpoint)
+        return row
+
+    def add_formula_term(self, row, term):
+        """Add a term to the formula of a flag or attribute, unless it is
+        already present."""
+        index = self.intern(term)
+        key = self._key(row, index)
+        if key not in self._formula_keys:
+            self._formula_keys.add(key)
+            self.formulas.setdefault(row, []).append(index)
+            if instrumentation.hook is not None:
+                instrumentation.hook('count', 'formula_appends', 1)
+
+    def formula(self, row):
+        """Return the formula of a flag or attribute, or None."""
+        terms = self.formulas.get(row)
+        if not terms:
+            return None
+        return formula_separators[self.types[row]].join(self.strings[term]
+                                                        for term in terms)
+
+    def node_id(self, row):
+        """Return the ID of the node, as given by the corresponding core node.
+        """
+        prefix = id_prefixes.get(self.types[row])
+        if prefix is None:
+            return self.ids[row]
+        return '%s%s' % (prefix, self.ids[row])
+
+    def children(self, row):
+        """Return the rows of the children of the node, in order of creation.
+        """
+        children = []
+        child = self.first_children[row]
+        while child >= 0:
+            children.append(child)
+            child = self.next_siblings[child]
+        children.reverse()
+        return children
+
+    def endpoints(self, row):
+        """Return the rows of the endpoints of a relationship."""
+        start = bisect.bisect_left(self.edge_relationships, row)
+        end = bisect.bisect_right(self.edge_relationships, row, start)
+        return self.edge_nodes[start:end].tolist()
+
+    def path(self, row):
+        """Return the list of IDs from the agent down to the node."""
+        path = []
+        while row >= 0:
+            path.append(self.ids[row])
+            row = self.parents[row]
+        path.reverse()
+        return path
+
+    # Object API ==============================================================
+
+    def view(self, row):
+        """Return a ColumnarNode view of the node in the row."""
+        return ColumnarNode(self, row)
+
+    def get_create_agent(self, name):
+        """Return a view of the agent with the given name, adding it if
+        necessary."""
+        return self.view(self.get_create(AGENT, -1, name))
+
+    def add_phosphorylation(self, source, target):
+        """Add a Phosphorylation between the nodes of two views, returning
+        a view of it."""
+        return self.view(self.add_relationship(PHOSPHORYLATION,
+                                               [source.row, target.row]))
+
+    def add_bind(self, node1, node2):
+        """Add a Bind between the nodes of two views, returning a view of it.
+        """
+        return self.view(self.add_relationship(BIND, [node1.row, node2.row]))
+
+    # Exporters ===============================================================
+
+    def _selection(self, nodes):
+        """Return a bytearray marking the rows of the given views, or all of
+        the rows if nodes is None."""
+        if nodes is None:
+            return bytearray('\x01') * len(self.types)
+        selected = bytearray(len(self.types))
+        for node in nodes:
+            selected[node.row] = 1
+        return selected
+
+    def _paths(self):
+        """Return the paths of all of the nodes, in a single pass down the
+        rows (relationships get the path of their ID alone)."""
+        ids = self.ids
+        paths = []
+        for row, parent in enumerate(self.parents):
+            if parent < 0:
+                paths.append([ids[row]])
+            else:
+                paths.append(paths[parent] + [ids[row]])
+        return paths
+
+    def kami_records(self, nodes=None):
+        """Generate the Kami JSON records for the model, section by section.
+
+        Yields the same (section, record) tuples as
+        indra_to_kami.kami_records does for the corresponding core nodes.
+        Each section is generated by a pass over the columns, in the order
+        of the rows.
+
+        Parameters
+        ----------
+        nodes : iterable of ColumnarNode
+            The nodes to export; if not given, the whole model is exported.
+            The flags and attributes of the exported components are always
+            included, as are the flags and attributes among the nodes.
+        """
+        types = self.types
+        parents = self.parents
+        names = self.names
+        ids = self.ids
+        strings = self.strings
+        selected = self._selection(nodes)
+        paths = self._paths()
+        rows = xrange(len(types))
+
+        yield ('infos', {'scale':1, 'center':'A'})
+
+        # AGENTS
+        for row in rows:
+            if selected[row] and types[row] == AGENT:
+                yield ('agents', {'class':['node', 'agent'],
+                                  'name':ids[row],
+                                  'label': strings[names[row]],
+                                  'cx':None,
+                                  'cy':None,
+                                  'family':None,
+                                  'abstract':False})
+        # SITES
+        for row in rows:
+            if selected[row] and types[row] == SITE:
+                yield ('regions', {'class': ['node', 'region'],
+                                   'name': ids[row],
+                                   'label': strings[names[row]],
+                                   'ag_name': ids[parents[row]],
+                                   'color': None})
+        # FLAGS AND ATTRIBUTES, of the exported components (key residues
+        # are not included in the output, but their flags and attributes
+        # are) and those exported themselves
+        for row in rows:
+            node_type = types[row]
+            if node_type != FLAG and node_type != ATTRIBUTE:
+                continue
+            parent = parents[row]
+            if not (selected[row] or selected[parent]):
+                continue
+            yield ('attributes' if node_type == ATTRIBUTE else 'flags',
+                   {'class': ['node', kami_classes[node_type]],
+                    'name': ids[row],
+                    'label': strings[names[row]],
+                    'dest_class': ['node', kami_classes[types[parent]]],
+                    'dest_path': paths[parent],
+                    'values': [], # FIXME
+                    'v_equiv': None})
+        # ACTIONS, sharing the class lists and the context of each component
+        # between records, as indra_to_kami.kami_records does
+        binder_class = ['node', 'binder']
+        edge_class = ['edge']
+        action_class = ['node', 'action', 'mod']
+        node_classes = dict((node_type, ['node', kami_class])
+                            for node_type, kami_class in
+                            kami_classes.iteritems())
+        contexts = {}
+
+        def ancestor_context(node):
+            context = contexts.get(node)
+            if context is None:
+                node_type = types[node]
+                element = {'el_cl': node_classes[node_type],
+                           'el_path': paths[node]}
+                if node_type == FLAG or node_type == ATTRIBUTE:
+                    element['el_value'] = ['unphos']
+                context = [element]
+                if parents[node] >= 0:
+                    context += ancestor_context(parents[node])
+                contexts[node] = context
+            return context
+
+        endpoints = {}
+        for rel, node in zip(self.edge_relationships, self.edge_nodes):
+            if selected[rel] and types[rel] == PHOSPHORYLATION:
+                endpoints.setdefault(rel, []).append(node)
+        for row in rows:
+            if not (selected[row] and types[row] == PHOSPHORYLATION):
+                continue
+            rel_id = self.node_id(row)
+            source, target = endpoints[row]
+            yield ('actions_binder', {'class': binder_class,
+                                      'name': 'left',
+                                      'act_name': rel_id})
+            yield ('actions_binder', {'class': binder_class,
+                                      'name': 'right',
+                                      'act_name': rel_id})
+            yield ('edges', {'class': edge_class,
+                             'in_class': binder_class,
+                             'in_path': [rel_id, 'right'],
+                             'out_class': node_classes[types[target]],
+                             'out_path': paths[target]})
+            # Context for the enzyme and substrate and all of their parents
+            yield ('actions', {'class': action_class,
+                               'name': rel_id,
+                               'label': rel_id,
+                               'context': ancestor_context(source) +
+                                          ancestor_context(target)})
+
+    def write_dot(self, f, name):
+        """Write the model to a file in DOT format.
+
+        The graph is the one rendered by core.Graph for the corresponding
+        core nodes, with a cluster for each agent containing all of the
+        nodes within it. It is written with a DotWriter, in passes over the
+        columns.
+        """
+        types = self.types
+        parents = self.parents
+        names = self.names
+        ids = self.ids
+        strings = self.strings
+        rows = xrange(len(types))
+        g = DotWriter(f, name)
+        # The nodes of the agents, and the edges to them from their parents
+        clusters = {}
+        roots = array.array('l')
+        for row in rows:
+            node_type = types[row]
+            parent = parents[row]
+            roots.append(row if parent < 0 else roots[parent])
+            if node_type >= PHOSPHORYLATION:
+                continue
+            if node_type == FLAG or node_type == ATTRIBUTE:
+                label = '%s: %s' % (strings[names[row]], self.formula(row))
+            else:
+                label = strings[names[row]]
+            g.add_node(ids[row], label=label, **styles[node_type])
+            clusters.setdefault(roots[row], []).append(ids[row])
+        for row in rows:
+            parent = parents[row]
+            if parent >= 0:
+                g.add_edge(ids[parent], ids[row],
+                           label=child_labels[types[row]], **edge_style)
+        for row in rows:
+            if types[row] == AGENT:
+                g.add_subgraph(clusters[row], 'cluster_%s' % ids[row])
+        # The relationships, with edges from their sources and to their
+        # targets (Binds only have sources)
+        for row in rows:
+            if types[row] >= PHOSPHORYLATION:
+                rel_id = self.node_id(row)
+                g.add_node(rel_id, label=rel_id, **styles[types[row]])
+        last = -1
+        for rel, node in zip(self.edge_relationships, self.edge_nodes):
+            if types[rel] == PHOSPHORYLATION and rel == last:
+                g.add_edge(self.node_id(rel), ids[node],
+                           **Relationship.edge_style)
+            else:
+                g.add_edge(ids[node], self.node_id(rel),
+                           **Relationship.edge_style)
+            last = rel
+        g.close()
+
+
+class ColumnarNode(object):
+    """View of a node stored in a ColumnarGraph.
+
+    Provides the parts of the interface of the core nodes used to build and
+    inspect a model. Views are created on demand, and views of the same row
+    are equal to each other.
+
+    Parameters
+    ----------
+    graph : ColumnarGraph
+        The graph in which the node is stored.
+    row : int
+        The row of the node.
+    """
+    __slots__ = ('graph', 'row')
+
+    def __init__(self, graph, row):
+        self.graph = graph
+        self.row = row
+
+    def __eq__(self, other):
+        return isinstance(other, ColumnarNode) and \
+               self.graph is other.graph and self.row == other.row
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.graph), self.row))
+
+    @property
+    def node_type(self):
+        """The type code of the node (see ColumnarGraph.types)."""
+        return self.graph.types[self.row]
+
+    @property
+    def id(self):
+        return self.graph.node_id(self.row)
+
+    @property
+    def name(self):
+        name = self.graph.names[self.row]
+        return self.graph.strings[name] if name >= 0 else self.id
+
+    @property
+    def parent(self):
+        parent = self.graph.parents[self.row]
+        return self.graph.view(parent) if parent >= 0 else None
+
+    @property
+    def path(self):
+        return self.graph.path(self.row)
+
+    def children(self):
+        """Return views of the nodes whose parent is this node."""
+        return [self.graph.view(row) for row in self.graph.children(self.row)]
+
+    def descendants(self):
+        """Return views of the children of the node, their children, etc."""
+        descendants = []
+        for child in self.children():
+            descendants.append(child)
+            descendants += child.descendants()
+        return descendants
+
+    def _children_dict(self, node_type):
+        return dict((child.name, child) for child in self.children()
+                    if child.node_type == node_type)
+
+    @property
+    def sites(self):
+        return self._children_dict(SITE)
+
+    @property
+    def key_residues(self):
+        return self._children_dict(KEY_RESIDUE)
+
+    @property
+    def flags(self):
+        return self._children_dict(FLAG)
+
+    @property
+    def attributes(self):
+        return self._children_dict(ATTRIBUTE)
+
+    def _get_create(self, node_type, name):
+        return self.graph.view(self.graph.get_create(node_type, self.row,
+                                                     name))
+
+    def get_create_site(self, site_name):
+        """Return the site with the given name if present, or create it."""
+        return self._get_create(SITE, site_name)
+
+    def get_create_key_residue(self, kr_name):
+        """Return the residue with the given name if present, or create it."""
+        return self._get_create(KEY_RESIDUE, kr_name)
+
+    def get_create_flag(self, flag_name):
+        """Return the flag with the given name if present, or create it."""
+        return self._get_create(FLAG, flag_name)
+
+    def get_create_attribute(self, attribute_name):
+        """Return the attribute with the given name if present, or create it."""
+        return self._get_create(ATTRIBUTE, attribute_name)
+
+    @property
+    def formula(self):
+        return self.graph.formula(self.row)
+
+    @property
+    def formula_terms(self):
+        """The sequence of distinct terms of the formula."""
+        strings = self.graph.strings
+        return [strings[term] for term in self.graph.formulas.get(self.row,
+                                                                  ())]
+
+    def add_formula_term(self, term):
+        """Add a term to the formula, unless it is already present."""
+        self.graph.add_formula_term(self.row, term)
+
+    def endpoints(self):
+        """Return views of the nodes connected by a relationship."""
+        return [self.graph.view(row) for row in self.graph.endpoints(self.row)]
+
+    @property
+    def source(self):
+        return self.endpoints()[0]
+
+    @property
+    def target(self):
+        return self.endpoints()[1]
+
+    def detach(self):
+        """Relationships in a ColumnarGraph are never detached, as their IDs
+        are unique."""
+        pass
+
+    def __str__(self):
+        return ("%s(%s)" % (type_names[self.node_type], self.name))
@@ -0,0 +1,197 @@
+"""Persistent cache of the conversion of INDRA statements.
+
+Each statement converted by an IndraKamiConverter contributes some nodes
+(agents, sites, flags, relationships, ...) and formula terms to the model.
+A ConversionCache stores these contributions in an SQLite database, keyed
+by a fingerprint of the fields of the statement used by the conversion, so
+that on later runs the contribution of a statement seen before can be
+replayed without running the handler (see IndraKamiConverter.cache).
+
+A contribution is stored as a JSON list of operations, in the order in which
+the handler looked up or created the nodes (so that replaying them assigns
+the same IDs as the handler would):
+
+- ['agent', name]
+- ['site', parent, name], and likewise for 'key_residue', 'flag' and
+  'attribute', where parent is the index of the operation giving the parent
+- ['phosphorylation', source, target]
+- ['formula', node, term], adding a term to the formula of a flag or
+  attribute; the term is either a string, or the index of the operation
+  giving the relationship whose ID is the term.
+"""
+import json
+import sqlite3
+import hashlib
+from columnar import AGENT, SITE, KEY_RESIDUE, FLAG, ATTRIBUTE, \
+                     PHOSPHORYLATION, type_code
+
+# The operations creating the nodes of each type
+operations = {AGENT: 'agent', SITE: 'site', KEY_RESIDUE: 'key_residue',
+              FLAG: 'flag', ATTRIBUTE: 'attribute',
+              PHOSPHORYLATION: 'phosphorylation'}
+
+# Version of the layout of the database
+schema_version = 1
+
+def statement_fingerprint(stmt, fields, version=0):
+    """Return a fingerprint of the given fields of a statement.
+
+    Parameters
+    ----------
+    stmt : indra.statements.Statement
+        The statement.
+    fields : list of string
+        The names of the fields of the statement, which may be dotted to
+        get fields of fields (e.g., 'enz.name').
+    version : int or string
+        Included in the fingerprint, so that changing it invalidates the
+        fingerprints computed before.
+    """
+    values = [version, type(stmt).__name__]
+    for field in fields:
+        value = stmt
+        for name in field.split('.'):
+            value = getattr(value, name)
+        values.append(value)
+    return hashlib.sha1(json.dumps(values)).hexdigest()
+
+def record_operations(nodes, formula_terms):
+    """Return the operations reproducing the contribution of a statement.
+
+    Parameters
+    ----------
+    nodes : list of nodes
+        The nodes returned by the handler of the statement, in the order in
+        which the handler looked them up or created them. They must include
+        the parent of each node and the endpoints of each relationship.
+    formula_terms : list of (node, string) tuples
+        The formula terms added by the handler, in order.
+
+    Returns None if the contribution cannot be recorded (e.g., if it
+    contains a type of node that cannot be replayed).
+    """
+    ops = []
+    indices = {}
+    for node in nodes:
+        if node in indices:
+            continue
+        code = type_code(node)
+        if code not in operations:
+            return None
+        if code == AGENT:
+            op = ['agent', node.name]
+        elif code == PHOSPHORYLATION:
+            endpoints = node.endpoints()
+            if not all(endpoint in indices for endpoint in endpoints):
+                return None
+            op = ['phosphorylation'] + [indices[endpoint]
+                                        for endpoint in endpoints]
+        else:
+            if node.parent not in indices:
+                return None
+            op = [operations[code], indices[node.parent], node.name]
+        indices[node] = len(ops)
+        ops.append(op)
+    relationship_ids = dict((str(node.id), indices[node]) for node in nodes
+                            if type_code(node) == PHOSPHORYLATION)
+    for node, term in formula_terms:
+        if node not in indices:
+            return None
+        ops.append(['formula', indices[node],
+                    relationship_ids.get(term, term)])
+    return ops
+
+
+class ConversionCache(object):
+    """An SQLite database of the contributions of converted statements.
+
+    Entries are looked up with get and stored with put; the changes are
+    committed, and the database trimmed to max_entries by evicting the
+    least recently used entries, by flush (or close).
+
+    Parameters
+    ----------
+    filename : string
+        The name of the database file, which is created if necessary.
+    max_entries : int
+        The maximum number of statements kept in the cache.
+    """
+    def __init__(self, filename, max_entries=1000000):
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = str
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                                '(key TEXT PRIMARY KEY, value INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS contributions '
+                                '(fingerprint TEXT PRIMARY KEY, '
+                                'operations TEXT, last_used INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS last_used_index '
+                                'ON contributions (last_used)')
+        if self._meta('schema_version', schema_version) != schema_version:
+            self.connection.execute('DELETE FROM contributions')
+            self._set_meta('schema_version', schema_version)
+        # Each use of the cache is a new generation; entries are stamped
+        # with the generation in which they were last used
+        self.generation = self._meta('generation', 0) + 1
+        self._set_meta('generation', self.generation)
+        self.connection.commit()
+        # The fingerprints of the entries used since the last flush
+        self._used = set([])
+        self.hits = 0
+        self.misses = 0
+
+    def _meta(self, key, default):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            self._set_meta(key, default)
+            return default
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                (key, value))
+
+    def __len__(self):
+        return self.connection.execute(
+                        'SELECT COUNT(*) FROM contributions').fetchone()[0]
+
+    def get(self, fingerprint):
+        """Return the operations stored for the fingerprint, or None."""
+        row = self.connection.execute('SELECT operations FROM contributions '
+                                      'WHERE fingerprint = ?',
+                                      (fingerprint,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(fingerprint)
+        return json.loads(row[0])
+
+    def put(self, fingerprint, ops):
+        """Store the operations for the fingerprint."""
+        self.connection.execute('INSERT OR REPLACE INTO contributions '
+                                'VALUES (?, ?, ?)',
+                                (fingerprint, json.dumps(ops),
+                                 self.generation))
+
+    def flush(self):
+        """Commit the changes, and evict the least recently used entries
+        beyond max_entries."""
+        self.connection.executemany('UPDATE contributions SET last_used = ? '
+                                    'WHERE fingerprint = ?',
+                                    ((self.generation, fingerprint)
+                                     for fingerprint in self._used))
+        self._used = set([])
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute('DELETE FROM contributions WHERE '
+                                    'fingerprint IN (SELECT fingerprint FROM '
+                                    'contributions ORDER BY last_used '
+                                    'LIMIT ?)', (excess,))
+        self.connection.commit()
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.connection.close()
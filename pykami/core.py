@@ -1,15 +1,60 @@
-from pygraphviz import *
+import re
+import math
+import StringIO
+import instrumentation
 
 edge_style = {'fontname': 'arial', 'fontsize': 9}
 
 id_counter = 0
 
-def get_id():
-    """Get a unique identifier for each component as it is created."""
+# If True, identifiers are derived from the semantic path of each component
+# rather than from the order in which components are created
+stable_ids = False
+
+def use_stable_ids(enable=True):
+    """Switch between stable (path-derived) and sequential identifiers.
+
+    Stable identifiers are a hash of the path of names leading to a
+    component (e.g., agent name, site name, flag name), or of the type and
+    endpoints of a relationship. They are the same across runs and
+    processes, regardless of the order in which the components are created.
+    Only components created after the switch are affected.
+    """
+    global stable_ids
+    stable_ids = enable
+
+def get_id(*path):
+    """Get a unique identifier for each component as it is created.
+
+    The path should identify the component semantically; it is used only if
+    stable identifiers are enabled (see use_stable_ids).
+    """
     global id_counter
+    if stable_ids and path:
+        return get_stable_id(*path)
     id_counter += 1
     return id_counter
 
+def get_stable_id(*path):
+    """Get an identifier determined only by the given path."""
+    # Imported here, as only stable identifiers need it
+    import hashlib
+    key = '\x1f'.join(part.encode('utf-8') if isinstance(part, unicode)
+                       else str(part) for part in path)
+    return hashlib.sha1(key).hexdigest()[:16]
+
+def _parent_id(parent):
+    """Return the ID of the parent to use in the path for a child's ID."""
+    return parent.id if parent is not None else ''
+
+
+def _not_a_node(node):
+    """Return the TypeError raised by Graph for objects other than core
+    nodes."""
+    return TypeError('Cannot render %r: not a node (the DOT file of a '
+                     'columnar.ColumnarGraph is written with its write_dot '
+                     'method)' % (node,))
+
 
 class Graph(object):
     """A container for the nodes and relationships in the graph.
@@ -30,11 +75,18 @@ class Graph(object):
     ----------
     g : pygraphviz.AGraph
         Instance of the PyGraphviz graph to which the nodes are rendered.
+        It is only created (and pygraphviz imported) when first used; the
+        DOT file can be written without pygraphviz with write_dot.
     """
     def __init__(self, name, nodes):
         self.name = name
         self.nodes = nodes
-        self.g = AGraph(name=name, directed=True)
+        self._g = None
+        # For each agent rendered, the version of the agent that was rendered
+        # and the IDs of the nodes in its cluster
+        self._rendered_agents = {}
+        # The relationships rendered
+        self._rendered_relationships = set([])
 
     def render(self):
         """Recursively render nodes, sub-nodes and edges.
@@ -47,30 +99,506 @@ class Graph(object):
         rendered afterwards, because the node labels and properties do not
         come out correctly if the nodes are referenced by an edge before
         they are explicitly created.
+
+        Rendering again only redraws the agents that have changed since they
+        were last rendered (see Component.version), along with the
+        relationships connected to them, and draws any new nodes.
+        """
+        with instrumentation.Stage('render') as stage:
+            relationships = []
+            # IDs of the nodes removed from the graph to redraw their agents
+            removed_ids = set([])
+            # Iterate over all of the nodes, rendering only the agents (but
+            # collecting the relationships for the next round of rendering)
+            for node in self.nodes:
+                if isinstance(node, Agent):
+                    rendered = self._rendered_agents.get(node)
+                    if rendered is not None:
+                        version, agent_nodes = rendered
+                        if version == node.version:
+                            continue
+                        # Remove the previous rendering of the agent,
+                        # including the edges of any relationships connected
+                        # to it
+                        self.g.delete_subgraph('cluster_%s' % node.id)
+                        self.g.delete_nodes_from(agent_nodes)
+                        removed_ids.update(agent_nodes)
+                    agent_nodes = node.render(self.g)
+                    self._rendered_agents[node] = (node.version, agent_nodes)
+                    stage.items += 1
+                elif isinstance(node, Relationship):
+                    relationships.append(node)
+                elif not isinstance(node, Node):
+                    raise _not_a_node(node)
+            # Iterate again, rendering the relationships this time
+            for rel in relationships:
+                if rel in self._rendered_relationships and \
+                   removed_ids.isdisjoint(rel.endpoint_ids()):
+                    continue
+                rel.render(self.g)
+                self._rendered_relationships.add(rel)
+
+    @property
+    def g(self):
+        if self._g is None:
+            from pygraphviz import AGraph
+            self._g = AGraph(name=self.name, directed=True)
+        return self._g
+
+    def write(self):
+        """Write the graph to a file after rendering."""
+        self.g.write('%s.dot' % self.name)
+
+    def write_dot(self, f=None):
+        """Write the graph in DOT format without using pygraphviz.
+
+        The nodes are rendered as by render, but the nodes, edges and
+        clusters are written to the file as they are rendered, rather than
+        built up in a pygraphviz graph, so this is much faster for large
+        graphs and uses little memory. The graph described is the same as
+        the one written by render and write.
+
+        Parameters
+        ----------
+        f : file
+            The file to write to. If not given, the graph is written to
+            '<name>.dot', as by write.
         """
+        if f is None:
+            with open('%s.dot' % self.name, 'w') as f:
+                return self.write_dot(f)
+        g = DotWriter(f, self.name)
         relationships = []
-        # Iterate over all of the nodes, rendering only the agents (but
-        # collecting the relationships for the next round of rendering)
         for node in self.nodes:
             if isinstance(node, Agent):
-                node.render(self.g)
+                node.render(g)
             elif isinstance(node, Relationship):
                 relationships.append(node)
-        # Iterate again, rendering the relationships this time
+            elif not isinstance(node, Node):
+                raise _not_a_node(node)
         for rel in relationships:
-            rel.render(self.g)
+            rel.render(g)
+        g.close()
+
+    def connected_components(self):
+        """Split the agents and relationships into connected components.
+
+        Two agents are connected if a relationship connects them or any of
+        the nodes they contain. Returns a list of lists of nodes, each
+        containing the agents of a component and the relationships between
+        them.
+        """
+        # Union-find over the agents, with path halving
+        parents = {}
+
+        def find(agent):
+            while parents[agent] is not agent:
+                parents[agent] = parents[parents[agent]]
+                agent = parents[agent]
+            return agent
+
+        relationships = []
+        for node in self.nodes:
+            if isinstance(node, Agent):
+                parents.setdefault(node, node)
+            elif isinstance(node, Relationship):
+                relationships.append(node)
+        for rel in relationships:
+            agents = [find(parents.setdefault(agent, agent))
+                      for agent in rel.endpoint_agents()]
+            for agent in agents[1:]:
+                parents[agent] = agents[0]
+        components = {}
+        for agent in parents:
+            components.setdefault(find(agent), []).append(agent)
+        for rel in relationships:
+            components[find(rel.endpoint_agents()[0])].append(rel)
+        return components.values()
+
+    def layout_parallel(self, f=None, prog='dot', processes=None):
+        """Lay out the connected components in parallel and pack them.
+
+        Each connected component (see connected_components) is laid out
+        separately with pygraphviz in a pool of worker processes. The
+        components are then packed into rows, by translating their
+        coordinates, and written together to a single DOT file with the
+        layout (which can be drawn with e.g. neato -n2).
+
+        Parameters
+        ----------
+        f : file
+            The file to write to. If not given, the graph is written to
+            '<name>.dot', as by write.
+        prog : string
+            The Graphviz layout program to use for the components.
+        processes : int
+            The number of worker processes. Defaults to the number of CPUs.
+        """
+        if f is None:
+            with open('%s.dot' % self.name, 'w') as f:
+                return self.layout_parallel(f, prog, processes)
+        import multiprocessing
+        tasks = [('component_%d' % i, nodes, prog)
+                 for i, nodes in enumerate(self.connected_components())]
+        pool = multiprocessing.Pool(processes)
+        try:
+            laid_out = pool.map(_layout_component, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        pack_dot(laid_out, f, self.name)
 
-    def write(self):
-        """Write the graph to a file after rendering."""
-        self.g.write('%s.dot' % self.name)
 
+def neighborhood(agents, k=1):
+    """Return the k-hop neighborhood of the given agents.
 
-class Component(object):
+    An agent is one hop from another if a relationship connects them, or
+    any of the nodes they contain. The relationships are found through the
+    index kept by the nodes, so the time taken is proportional to the size
+    of the neighborhood (and of the relationships at its boundary).
+
+    Returns a list of the agents within k hops of the given ones, all of
+    the nodes they contain, and the relationships between them, which can
+    be passed to Graph or nodes_to_kami.
+    """
+    def agent_relationships(agent):
+        relationships = list(agent.relationships)
+        for node in agent.descendants():
+            relationships += node.relationships
+        return relationships
+
+    hops = dict((agent, 0) for agent in agents)
+    frontier = list(hops)
+    for hop in range(1, k + 1):
+        next_frontier = []
+        for agent in frontier:
+            for rel in agent_relationships(agent):
+                for other in rel.endpoint_agents():
+                    if other not in hops:
+                        hops[other] = hop
+                        next_frontier.append(other)
+        frontier = next_frontier
+
+    nodes = []
+    relationships = set([])
+    for agent in hops:
+        nodes.append(agent)
+        nodes += agent.descendants()
+        for rel in agent_relationships(agent):
+            if all(other in hops for other in rel.endpoint_agents()):
+                relationships.add(rel)
+    return nodes + list(relationships)
+
+def _layout_component(task):
+    """Lay out the graph of the nodes, returning it in DOT format."""
+    name, nodes, prog = task
+    from pygraphviz import AGraph
+    dot = StringIO.StringIO()
+    Graph(name, nodes).write_dot(dot)
+    g = AGraph(string=dot.getvalue())
+    g.layout(prog=prog)
+    return g.string()
+
+# Attributes giving coordinates in laid out DOT graphs
+_position_re = re.compile(r'\b(pos|bb|lp|xlp|head_lp|tail_lp)="([^"]*)"')
+_bb_re = re.compile(r'\bbb="([^"]*)"')
+
+def _translate_points(value, dx, dy):
+    """Translate the coordinates in a pos, bb or lp attribute value."""
+    tokens = []
+    for token in value.split():
+        parts = token.split(',')
+        # Spline end points are prefixed by 's,' or 'e,'
+        prefix = parts[:1] if parts[0] in ('s', 'e') else []
+        coords = parts[len(prefix):]
+        # Positions may be pinned with a trailing '!'
+        suffix = '!' if coords[-1].endswith('!') else ''
+        coords[-1] = coords[-1].rstrip('!')
+        for i, coord in enumerate(coords):
+            # Written with the two decimals of Graphviz, without trailing
+            # zeros (%g would round large coordinates to six digits)
+            coord = '%.2f' % (float(coord) + (dx if i % 2 == 0 else dy))
+            coords[i] = coord.rstrip('0').rstrip('.')
+        tokens.append(','.join(prefix + coords) + suffix)
+    return ' '.join(tokens)
+
+def pack_dot(graphs, f, name, margin=36):
+    """Pack laid out DOT graphs into rows and write them as one graph.
+
+    The graphs (strings, as written by Graphviz after layout) are arranged
+    from the tallest to the shortest, in rows of roughly equal width, by
+    translating all of their coordinates. Each graph becomes a subgraph of
+    the graph written to the file.
+    """
+    pieces = []
+    for dot in graphs:
+        # Join lines continued with a backslash
+        dot = dot.replace('\\\n', '')
+        llx, lly, urx, ury = [float(x) for x in
+                              _bb_re.search(dot).group(1).split(',')]
+        # The statements of the graph, between the outer braces
+        body = dot[dot.index('{') + 1:dot.rindex('}')]
+        pieces.append((ury - lly, urx - llx, llx, lly, body))
+    pieces.sort(key=lambda piece: -piece[0])
+    area = sum((h + margin) * (w + margin) for h, w, _, _, _ in pieces)
+    row_width = max([math.sqrt(area)] + [w for _, w, _, _, _ in pieces])
+
+    f.write('digraph %s {\n' % _dot_id(name))
+    x = y = row_height = width = 0.
+    for i, (h, w, llx, lly, body) in enumerate(pieces):
+        if x > 0 and x + w > row_width:
+            x = 0.
+            y += row_height + margin
+            row_height = 0.
+        dx, dy = x - llx, y - lly
+        body = _position_re.sub(lambda m: '%s="%s"' % (m.group(1),
+                                    _translate_points(m.group(2), dx, dy)),
+                                body)
+        f.write('\tsubgraph %s {%s}\n' % (_dot_id('component_%d' % i), body))
+        x += w + margin
+        row_height = max(row_height, h)
+        width = max(width, x - margin)
+    height = y + row_height
+    f.write('\tgraph [bb="0,0,%g,%g"];\n' % (width, height))
+    f.write('}\n')
+
+def _dot_id(value):
+    """Return the value quoted as a DOT identifier."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"%s"' % str(value).replace('"', '\\"')
+
+
+class DotWriter(object):
+    """Writes a graph in DOT format to a file as it is built.
+
+    Supports the subset of the pygraphviz.AGraph interface used to render
+    nodes (add_node, add_edge and add_subgraph), so that nodes can be
+    rendered to it directly. As in a strict pygraphviz graph, repeated edges
+    are merged (by Graphviz, when the file is read).
+
+    Parameters
+    ----------
+    f : file
+        The file to write to.
+    name : string
+        The name of the graph.
+    """
+    def __init__(self, f, name):
+        self.f = f
+        self.f.write('strict digraph %s {\n' % _dot_id(name))
+
+    def _attributes(self, attr):
+        if not attr:
+            return ''
+        return ' [%s]' % ', '.join('%s=%s' % (key, _dot_id(attr[key]))
+                                   for key in sorted(attr))
+
+    def add_node(self, n, **attr):
+        self.f.write('\t%s%s;\n' % (_dot_id(n), self._attributes(attr)))
+
+    def add_edge(self, u, v, key=None, **attr):
+        if key is not None:
+            attr['key'] = key
+        self.f.write('\t%s -> %s%s;\n' % (_dot_id(u), _dot_id(v),
+                                         self._attributes(attr)))
+
+    def add_subgraph(self, nbunch, name, **attr):
+        self.f.write('\tsubgraph %s {\n' % _dot_id(name))
+        for key in sorted(attr):
+            self.f.write('\t\t%s=%s;\n' % (key, _dot_id(attr[key])))
+        for n in nbunch:
+            self.f.write('\t\t%s;\n' % _dot_id(n))
+        self.f.write('\t}\n')
+
+    def close(self):
+        """Finish the graph; the file itself is not closed."""
+        self.f.write('}\n')
+
+
+class Slotted(object):
+    """Parent class for nodes, which define __slots__ to save memory.
+
+    Provides pickling of all of the slots of the class and its parents.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, slot):
+                    state[slot] = getattr(self, slot)
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.iteritems():
+            object.__setattr__(self, slot, value)
+
+
+class NoChildren(dict):
+    """Empty dict standing in for the children of a component not yet added.
+
+    Components only create their dicts of children when the first child is
+    added, and until then return a new NoChildren for the dict, so that
+    reading the children of a component does not allocate a dict for it.
+    Storing a child in a NoChildren (with [], setdefault or update) makes it
+    the dict of children of the component.
+
+    Parameters
+    ----------
+    owner : Component
+        The component whose children the dict stands in for.
+    slot : string
+        The slot of the component holding its dict of children.
+    """
+    __slots__ = ('_owner', '_slot')
+
+    def __init__(self, owner, slot):
+        self._owner = owner
+        self._slot = slot
+
+    def __reduce__(self):
+        # Pickled as a plain dict
+        return (dict, (dict(self),))
+
+    def _children(self):
+        """Return the dict of children of the owner, making this dict the
+        dict of children if the owner has none yet."""
+        if self._owner is None:
+            return self
+        children = getattr(self._owner, self._slot)
+        if children is None:
+            setattr(self._owner, self._slot, self)
+            children = self
+        if children is self:
+            self._owner = None
+        return children
+
+    def __setitem__(self, key, value):
+        children = self._children()
+        if children is self:
+            dict.__setitem__(self, key, value)
+        else:
+            children[key] = value
+
+    def setdefault(self, key, default=None):
+        children = self._children()
+        if children is self:
+            return dict.setdefault(self, key, default)
+        return children.setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        children = self._children()
+        if children is self:
+            dict.update(self, *args, **kwargs)
+        else:
+            children.update(*args, **kwargs)
+
+
+class Node(Slotted):
+    """Parent class for Components and Flags, which have a parent node.
+
+    The path of IDs leading from the top-level agent down to the node is
+    computed once, on first use after the node is attached to its parent,
+    and cached until the parent of the node (or of one of its ancestors)
+    changes.
+
+    Nodes also index the relationships connecting them, which register
+    themselves with their endpoints when they are created. The index is not
+    pickled with the node, since following it would pickle the whole
+    network connected to the node (recursively, exceeding the recursion
+    limit for large networks); instead, the relationships that are pickled
+    register themselves again when unpickled.
+    """
+    __slots__ = ('id', 'name', '_parent', '_path', '_relationships')
+
+    def __getstate__(self):
+        state = super(Node, self).__getstate__()
+        state.pop('_relationships', None)
+        return state
+
+    def __setstate__(self, state):
+        super(Node, self).__setstate__(state)
+        # The relationships may have been registered already
+        if not hasattr(self, '_relationships'):
+            self._relationships = None
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        self.invalidate_path()
+
+    @property
+    def path(self):
+        """The list of IDs from the top-level agent down to this node.
+
+        The list is cached and shared, so it should not be modified.
+        """
+        if self._path is None:
+            if self._parent is None:
+                self._path = [self.id]
+            else:
+                self._path = self._parent.path + [self.id]
+        return self._path
+
+    @property
+    def relationships(self):
+        """The relationships having this node as an endpoint."""
+        return self._relationships or ()
+
+    def add_relationship(self, rel):
+        """Index a relationship having this node as an endpoint."""
+        if self._relationships is None:
+            self._relationships = []
+        self._relationships.append(rel)
+
+    def remove_relationship(self, rel):
+        """Remove a relationship from the index of the node."""
+        self._relationships = [r for r in self._relationships if r is not rel]
+
+    def descendants(self):
+        """Return the list of the children of the node, their children, etc.
+        """
+        descendants = []
+        for child in self.children():
+            descendants.append(child)
+            descendants += child.descendants()
+        return descendants
+
+    def mark_changed(self):
+        """Record a change to the node in the version of its agent."""
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        if isinstance(node, Component):
+            node._version += 1
+
+    def invalidate_path(self):
+        """Clear the cached path of this node and of its children."""
+        self._path = None
+        for child in self.children():
+            child.invalidate_path()
+
+    def children(self):
+        """Return the list of nodes whose parent is this node."""
+        return []
+
+
+class Component(Node):
     """Parent class for Agents, Sites, and KeyResidues.
 
     Agents, Sites and KeyResidues all shared functionality, in particular they
     can contain flags, attributes, and annotations.
 
+    The dicts of children (flags, attributes, and the sites and key residues
+    of subclasses) and the list of annotations are only created when first
+    needed; until then, the dicts are empty NoChildren dicts.
+
     Attributes
     ----------
     flags : dict
@@ -78,33 +606,82 @@ class Component(object):
     attributes : dict
         Dictionary mapping the name of an attribute to the Attribute object.
     """
+    __slots__ = ('is_abstract', '_flags', '_attributes', '_annotations',
+                 '_version')
+
     def __init__(self, name=None, parent=None, is_abstract=False, flags=None,
                  attributes=None, annotations=None):
-        # Get a globally unique, numeric identifier for the component
-        self.id = get_id()
+        # Get a globally unique identifier for the component
+        self.id = get_id(_parent_id(parent), type(self).__name__, name)
         self.name = name
+        self._flags = None
+        self._attributes = None
+        self._relationships = None
+        self._version = 0
         self.parent = parent
         self.is_abstract = is_abstract
+        if instrumentation.hook is not None:
+            instrumentation.hook('count', 'nodes.' + type(self).__name__, 1)
         # Flags
-        self.flags = {}
         if flags is None:
             flags = []
         for flag in flags:
             self.add_flag(flag)
         # Attributes
-        self.attributes = {}
         if attributes is None:
             attributes = []
         for attribute in attributes:
             self.add_attribute(attribute)
         # Any additional information
-        if annotations is None:
-            annotations = []
-        self.annotations = annotations
+        self._annotations = annotations
+
+    @property
+    def version(self):
+        """Number of changes to the component and the nodes it contains.
+
+        Only meaningful for top-level components (agents): it is incremented
+        whenever a child is added to the component or to any of the nodes
+        it contains, or a formula of one of them changes.
+        """
+        return self._version
+
+    @property
+    def flags(self):
+        return self._get_children('_flags')
+
+    @property
+    def attributes(self):
+        return self._get_children('_attributes')
+
+    @property
+    def annotations(self):
+        if self._annotations is None:
+            self._annotations = []
+        return self._annotations
+
+    @annotations.setter
+    def annotations(self, annotations):
+        self._annotations = annotations
+
+    def _get_children(self, slot):
+        """Return the dict of children in the slot, or a NoChildren standing
+        in for it."""
+        children = getattr(self, slot)
+        return children if children is not None else NoChildren(self, slot)
+
+    def _add_child(self, slot, child):
+        """Add a child to the dict in the slot, creating it if necessary."""
+        children = getattr(self, slot)
+        if children is None:
+            children = {}
+            setattr(self, slot, children)
+        children[child.name] = child
+        self.mark_changed()
 
     def add_flag(self, flag):
         """Add a flag to the flags dict."""
-        self.flags[flag.name] = flag
+        flag.parent = self
+        self._add_child('_flags', flag)
 
     def get_create_flag(self, flag_name):
         """Return the flag with the given name if present, or create it."""
@@ -112,12 +689,13 @@ class Component(object):
             return self.flags[flag_name]
         else:
             flag = Flag(flag_name, self, None)
-            self.flags[flag_name] = flag
+            self._add_child('_flags', flag)
             return flag
 
     def add_attribute(self, attribute):
         """Add an attribute to the attributes dict."""
-        self.attributes[attribute.name] = attribute
+        attribute.parent = self
+        self._add_child('_attributes', attribute)
 
     def get_create_attribute(self, attribute_name):
         """Return the attribute with the given name if present, or create it."""
@@ -125,9 +703,19 @@ class Component(object):
             return self.attributes[attribute_name]
         else:
             attribute = Attribute(attribute_name, self, None)
-            self.attributes[attribute_name] = attribute
+            self._add_child('_attributes', attribute)
             return attribute
 
+    def children(self):
+        """Return the sites, key residues, flags and attributes."""
+        children = []
+        # Sites and key residues are only defined by some of the subclasses
+        for child_dict in (getattr(self, 'sites', {}),
+                           getattr(self, 'key_residues', {}),
+                           self.flags, self.attributes):
+            children += child_dict.values()
+        return children
+
     def render(self, g):
         """Render flags and attributes for the component."""
         component_nodes = []
@@ -149,29 +737,40 @@ class Component(object):
 
 class Agent(Component):
     """Top-level nodes containing sites and key residues (e.g., proteins)"""
+    __slots__ = ('_sites', '_key_residues')
+
     def __init__(self, name, sites=None, key_residues=None,
                  is_abstract=False, flags=None, attributes=None,
                  annotations=None):
+        self._sites = None
+        self._key_residues = None
         # Parent constructor
         super(Agent, self).__init__(name, parent=None, is_abstract=is_abstract,
                                     flags=flags, attributes=attributes,
                                     annotations=annotations)
         # Sites
-        self.sites = {}
         if sites is None:
             sites = []
         for site in sites:
             self.add_site(site)
         # Key residues
-        self.key_residues = {}
         if key_residues is None:
             key_residues = []
         for kr in self.key_residues:
             self.add_key_residue(kr)
 
+    @property
+    def sites(self):
+        return self._get_children('_sites')
+
+    @property
+    def key_residues(self):
+        return self._get_children('_key_residues')
+
     def add_site(self, site):
         """Add a site to the sites dict."""
-        self.sites[site.name] = site
+        site.parent = self
+        self._add_child('_sites', site)
 
     def get_create_site(self, site_name):
         """Return the site with the given name if present, or create it."""
@@ -179,12 +778,13 @@ class Agent(Component):
             return self.sites[site_name]
         else:
             site = Site(site_name, self)
-            self.sites[site_name] = site
+            self._add_child('_sites', site)
             return site
 
     def add_key_residue(self, kr):
         """Add a key residue ite to the key residues dict."""
-        self.key_residues[kr.name] = kr
+        kr.parent = self
+        self._add_child('_key_residues', kr)
 
     def get_create_key_residue(self, kr_name):
         """Return the residue with the given name if present, or create it."""
@@ -192,7 +792,7 @@ class Agent(Component):
             return self.key_residues[kr_name]
         else:
             kr = KeyResidue(kr_name, self)
-            self.key_residues[kr_name] = kr
+            self._add_child('_key_residues', kr)
             return kr
 
     def render(self, g):
@@ -234,19 +834,25 @@ class Site(Component):
 
     Sites can contain key residues but not agents or other sites.
     """
+    __slots__ = ('_key_residues',)
+
     def __init__(self, name, parent, key_residues=None, is_abstract=False,
                  flags=None, attributes=None, annotations=None):
+        self._key_residues = None
         # Parent constructor
         super(Site, self).__init__(name, parent=parent, is_abstract=is_abstract,
                                    flags=flags, attributes=attributes,
                                    annotations=annotations)
         # Key residues
-        self.key_residues = {}
         if key_residues is None:
             key_residues = []
         for kr in self.key_residues:
             self.add_key_residue(kr)
 
+    @property
+    def key_residues(self):
+        return self._get_children('_key_residues')
+
     def render(self, g):
         """Build the graph for the site and its subnodes.
 
@@ -272,6 +878,8 @@ class KeyResidue(Component):
     Because they only have the functionality of the base Component class,
     the constructor only calls the parent class.
     """
+    __slots__ = ()
+
     def __init__(self, name, parent, is_abstract=False,
                  flags=None, attributes=None, annotations=None):
         # Parent constructor: makes sure 'parent' field is filled out
@@ -293,15 +901,63 @@ class KeyResidue(Component):
         kr_nodes += flags_attrs
         return kr_nodes
 
-class Flag(object):
+class Flag(Node):
+    """A named state of a component, defined by a formula.
+
+    The formula is kept as a list of distinct terms, which are only joined
+    into a string (with formula_separator) when the formula is rendered.
+    Assigning a string to the formula makes it the single term.
+    """
+    __slots__ = ('_formula_terms', '_formula_term_set')
+
+    formula_separator = ' or '
+    style = {'color':'pink', 'style': 'filled', 'shape':'component',
+             'fontname': 'arial', 'fontsize': 10, 'size': 15}
+
     def __init__(self, name, parent, formula=None):
-        self.id = get_id()
+        self.id = get_id(_parent_id(parent), type(self).__name__, name)
         #self.name = '%s%s' % (name, self.id)
         self.name = name
+        self._relationships = None
         self.parent = parent
         self.formula = formula
-        self.style = {'color':'pink', 'style': 'filled', 'shape':'component',
-                      'fontname': 'arial', 'fontsize': 10, 'size': 15}
+        if instrumentation.hook is not None:
+            instrumentation.hook('count', 'nodes.' + type(self).__name__, 1)
+
+    @property
+    def formula(self):
+        if not self._formula_terms:
+            return None
+        return self.formula_separator.join(self._formula_terms)
+
+    @formula.setter
+    def formula(self, formula):
+        # The list and set of terms are created with the first term
+        self._formula_terms = None
+        self._formula_term_set = None
+        if formula is not None:
+            self.add_formula_term(formula)
+        else:
+            self.mark_changed()
+
+    @property
+    def formula_terms(self):
+        """The sequence of distinct terms of the formula."""
+        return self._formula_terms or ()
+
+    def add_formula_term(self, term):
+        """Add a term to the formula, unless it is already present."""
+        if self._formula_terms is None:
+            self._formula_terms = [term]
+            self._formula_term_set = set([term])
+        elif term not in self._formula_term_set:
+            self._formula_term_set.add(term)
+            self._formula_terms.append(term)
+        else:
+            return
+        if instrumentation.hook is not None:
+            instrumentation.hook('count', 'formula_appends', 1)
+        self.mark_changed()
 
     def render(self, g):
         g.add_node(self.id, label='%s: %s' % (self.name, self.formula),
@@ -310,29 +966,79 @@ class Flag(object):
         return flag_nodes
 
 class Attribute(Flag):
+    __slots__ = ()
+
+    formula_separator = ',\\n'
+    style = {'color':'sandybrown', 'style': 'filled',
+             'shape':'component', 'fontname': 'arial',
+             'fontsize': 10, 'size': 15}
+
     def __init__(self, name, parent, formula):
         super(Attribute, self).__init__(name, parent, formula)
-        self.style = {'color':'sandybrown', 'style': 'filled',
-                      'shape':'component', 'fontname': 'arial',
-                      'fontsize': 10, 'size': 15}
 
 # Relationships ===============================================================
 
-class Relationship(object):
-    def __init__(self):
-        self.style = {'shape': 'square', 'fontname': 'arial',
-                'color': 'lightblue', 'style': 'filled', 'fontsize': 10}
-        self.edge_style = {'fontname': 'arial', 'fontsize': 9,
-                           'style': 'dotted'}
-        # Get an ID for this node
-        self.id = get_id()
+class Relationship(Slotted):
+    __slots__ = ('id',)
+
+    style = {'shape': 'square', 'fontname': 'arial',
+             'color': 'lightblue', 'style': 'filled', 'fontsize': 10}
+    edge_style = {'fontname': 'arial', 'fontsize': 9,
+                  'style': 'dotted'}
+
+    def __init__(self, endpoints=None):
+        # Get an ID for this node, identified by its type and endpoints
+        if endpoints is None:
+            endpoints = []
+        self.id = get_id(type(self).__name__,
+                         *[node.id for node in endpoints])
+        # Index the relationship in its endpoints
+        for node in endpoints:
+            node.add_relationship(self)
+        if instrumentation.hook is not None:
+            instrumentation.hook('count', 'nodes.' + type(self).__name__, 1)
+
+    def __setstate__(self, state):
+        super(Relationship, self).__setstate__(state)
+        # Index the relationship in its endpoints again (see Node)
+        for node in self.endpoints():
+            node.add_relationship(self)
+
+    def detach(self):
+        """Remove the relationship from the index of its endpoints."""
+        for node in self.endpoints():
+            node.remove_relationship(self)
+
+    def endpoints(self):
+        """Return the nodes connected by the relationship."""
+        return []
+
+    def endpoint_ids(self):
+        """Return the IDs of the nodes connected by the relationship."""
+        return [node.id for node in self.endpoints()]
+
+    def endpoint_agents(self):
+        """Return the agents containing the nodes connected by the
+        relationship."""
+        agents = []
+        for node in self.endpoints():
+            while node.parent is not None:
+                node = node.parent
+            agents.append(node)
+        return agents
 
 class DirectedBinary(Relationship):
+    __slots__ = ('source', 'target')
+
     def __init__(self, source, target):
-        super(DirectedBinary, self).__init__()
+        super(DirectedBinary, self).__init__([source, target])
         self.source = source
         self.target = target
 
+    def endpoints(self):
+        """Return the source and target nodes."""
+        return [self.source, self.target]
+
     def render(self, g):
         # Add this node to the graph
         #import ipdb; ipdb.set_trace()
@@ -343,14 +1049,28 @@ class DirectedBinary(Relationship):
         g.add_edge(self.id, self.target.id, **self.edge_style)
 
 class Phosphorylation(DirectedBinary):
+    __slots__ = ()
+
+    name = 'p'
+
     def __init__(self, source, target):
         super(Phosphorylation, self).__init__(source, target)
-        self.name = 'p'
         self.id = '%s%s' % (self.name, self.id)
 
 class UndirectedNAry(Relationship):
-    def __init__(self):
-        super(UndirectedNAry, self).__init__()
+    __slots__ = ('node_list',)
+
+    def __init__(self, node_list=None):
+        if node_list is None:
+            node_list = []
+        # The order of the nodes does not matter, so sort them for the ID
+        super(UndirectedNAry, self).__init__(
+                                sorted(node_list, key=lambda n: str(n.id)))
+        self.node_list = node_list
+
+    def endpoints(self):
+        """Return the nodes in the node list."""
+        return self.node_list
 
     def render(self, g):
         # Add this node to the graph
@@ -361,11 +1081,13 @@ class UndirectedNAry(Relationship):
             g.add_edge(node.id, self.id, **self.edge_style)
 
 class Bind(UndirectedNAry):
+    __slots__ = ()
+
+    name = 'b'
+
     def __init__(self, node1, node2):
-        super(Bind, self).__init__()
-        self.node_list = [node1, node2]
-        self.name = 'b'
-        self.id = '%s%d' % (self.name, self.id)
+        super(Bind, self).__init__([node1, node2])
+        self.id = '%s%s' % (self.name, self.id)
 
 if __name__ == '__main__':
     nodes = []
@@ -390,11 +1112,11 @@ if __name__ == '__main__':
 
     RAF1 = Agent('RAF1')
     nodes.append(RAF1)
-    RAF1_Y341 = KeyResidue('Y341')
+    RAF1_Y341 = KeyResidue('Y341', RAF1)
     RAF1.add_key_residue(RAF1_Y341)
-    RAF1_S338 = KeyResidue('S338')
+    RAF1_S338 = KeyResidue('S338', RAF1)
     RAF1.add_key_residue(RAF1_S338)
-    RAF1_active = Flag('active', 'example_formula')
+    RAF1_active = Flag('active', RAF1, 'example_formula')
     RAF1.add_flag(RAF1_active)
 
     # Src phosphorylates RAF1 on Y341
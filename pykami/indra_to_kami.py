@@ -1,7 +1,10 @@
-import pickle
 import sys
-import indra.statements
+import shutil
+import itertools
+import instrumentation
 from core import *
+from columnar import ColumnarGraph, ColumnarNode
+from readers import batches, read_statements
 import json
 
 flag_names = {
@@ -26,31 +29,349 @@ kami_types = {
         'Flag': 'flag'
         }
 
+class NodeSet(object):
+    """A set of nodes iterating in the order in which they were added.
+
+    The converter's nodes are kept in a NodeSet rather than a set (which
+    iterates in order of the addresses of the nodes), so that exports of the
+    same model come out in the same order on every run.
+
+    Parameters
+    ----------
+    nodes : iterable of nodes
+        The initial nodes.
+    """
+    def __init__(self, nodes=()):
+        self._members = set([])
+        self._order = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node not in self._members:
+            self._members.add(node)
+            self._order.append(node)
+
+    def __contains__(self, node):
+        return node in self._members
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+
 class IndraKamiConverter(object):
+    """Converts INDRA statements into Kami nodes.
+
+    Attributes
+    ----------
+    handlers : dict
+        Maps the name of each type of INDRA statement to the name of the
+        method converting it. Statements of subclasses of these types are
+        converted by the same method; statements of other types are ignored.
+        The types are given by name so that indra.statements is only
+        imported when statements are read (e.g., unpickled). The
+        methods return the nodes they obtain, in the order in which they
+        looked them up or created them.
+    fingerprint_fields : dict
+        Maps the name of each handler method to the fields of the
+        statements that it uses, which identify the statements in the
+        cache. Handlers without fingerprint fields are not cached.
+    cache_version : int
+        Included in the fingerprints of statements, so that it can be
+        changed to invalidate the cache when the handlers change.
+    nodes : NodeSet
+        The set of all nodes obtained from the statements converted so far,
+        in the order in which they were obtained.
+    site_names : dict
+        Intern table mapping the modifications and positions of a statement
+        to the canonical names of the site and flag (see site_flag_names).
+    new_nodes : NodeSet
+        The nodes added to the nodes set since the last export (see
+        mark_exported and kami_patch).
+    cache : conversion_cache.ConversionCache
+        If given, the contribution of each statement converted (its nodes
+        and formula terms) is stored in the cache, and replayed from the
+        cache instead of running the handler when an identical statement is
+        converted on a later run. The cache is not used by the workers of
+        convert_parallel.
+    store : columnar.ColumnarGraph
+        If given, the model is built in the columnar store rather than as a
+        tree of core nodes, and the nodes are ColumnarNode views of it. The
+        model can then be exported from the store (e.g., with
+        nodes_to_kami(ikc.store) or ikc.store.write_dot).
+    registry : agent_registry.DiskAgentRegistry
+        If given, the agents and relationships are kept on disk by the
+        registry, which is used as the nodes_dict, relationships and nodes
+        set, with only the most recently used agents in memory, so that
+        models larger than memory can be converted, and exported with
+        write_kami. The registry is trimmed between statements (so nodes
+        should not be kept across statements) and flushed at the end of
+        each conversion. New nodes are not tracked, so kami_patch is not
+        available.
+    """
+    handlers = {
+        'Phosphorylation': 'phosphorylation',
+        'ActivityModification': 'activity_modification',
+        }
+
+    fingerprint_fields = {
+        'phosphorylation': ['enz.name', 'sub.name', 'mod', 'mod_pos'],
+        'activity_modification': ['monomer.name', 'mod', 'mod_pos',
+                                  'relationship', 'activity'],
+        }
+
+    cache_version = 1
+
+    def __init__(self, store=None, cache=None, registry=None):
+        if store is not None and registry is not None:
+            raise ValueError('A registry cannot be used with a store')
+        self.store = store
+        self.cache = cache
+        self.registry = registry
+        # The formula terms added while recording a statement for the cache
+        self._formula_log = None
+        self.site_names = {}
+        if registry is not None:
+            self.nodes_dict = registry
+            self.relationships = registry.relationships
+            self.nodes = registry.nodes
+            self.new_nodes = None
+        else:
+            self.nodes_dict = {}
+            self.relationships = {}
+            self.nodes = NodeSet()
+            self.new_nodes = NodeSet()
+        # Handler methods found for each statement type, including subclasses
+        # of the types in the handlers table
+        self._handler_cache = {}
+
+    def get_handler(self, stmt_type):
+        """Return the method converting statements of the given type.
+
+        Returns None if there is no handler for the type.
+        """
+        if stmt_type not in self._handler_cache:
+            handler = None
+            for cls in stmt_type.__mro__:
+                if cls.__name__ in self.handlers:
+                    handler = getattr(self, self.handlers[cls.__name__])
+                    break
+            self._handler_cache[stmt_type] = handler
+        return self._handler_cache[stmt_type]
+
+    def convert(self, stmts):
+        """Convert the statements from any iterable, e.g. a generator.
+
+        The statements are converted one at a time as they are read from the
+        iterable, and the nodes obtained are added to the nodes set.
+
+        Returns the nodes set.
+        """
+        with instrumentation.Stage('convert') as stage:
+            num_stmts = 0
+            for stmt in stmts:
+                num_stmts += 1
+                handler = self.get_handler(type(stmt))
+                if handler is None:
+                    continue
+                if self.cache is not None:
+                    self.add_nodes(self.convert_cached(stmt, handler))
+                else:
+                    self.add_nodes(handler(stmt))
+                if self.registry is not None:
+                    self.registry.trim()
+            stage.items = num_stmts
+        if self.cache is not None:
+            self.cache.flush()
+        if self.registry is not None:
+            self.registry.flush()
+        return self.nodes
+
+    def convert_cached(self, stmt, handler):
+        """Convert a statement with the handler, or replay it from the cache.
+
+        Returns the nodes obtained from the statement.
+        """
+        # Imported here rather than with the module, as it loads sqlite3
+        from conversion_cache import statement_fingerprint, record_operations
+        fields = self.fingerprint_fields.get(handler.__name__)
+        if fields is None:
+            return handler(stmt)
+        fingerprint = statement_fingerprint(stmt, fields, self.cache_version)
+        ops = self.cache.get(fingerprint)
+        if ops is not None:
+            return self.replay(ops)
+        self._formula_log = []
+        try:
+            nodes = handler(stmt)
+            ops = record_operations(nodes, self._formula_log)
+        finally:
+            self._formula_log = None
+        if ops is not None:
+            self.cache.put(fingerprint, ops)
+        return nodes
+
+    def replay(self, ops):
+        """Replay the operations recorded for a statement (see
+        conversion_cache), returning the nodes obtained."""
+        nodes = []
+        for op in ops:
+            kind = op[0]
+            if kind == 'agent':
+                node = self.get_create_agent(op[1])
+            elif kind == 'phosphorylation':
+                node = self.create_phosphorylation(nodes[op[1]], nodes[op[2]])
+            elif kind == 'formula':
+                term = op[2]
+                if not isinstance(term, basestring):
+                    term = str(nodes[term].id)
+                self.add_formula_term(nodes[op[1]], term)
+                continue
+            else:
+                node = getattr(nodes[op[1]], 'get_create_' + kind)(op[2])
+            nodes.append(node)
+        return nodes
+
+    def add_formula_term(self, node, term):
+        """Add a term to the formula of a flag or attribute.
+
+        Handlers add formula terms with this method so that they can be
+        recorded for the cache.
+        """
+        if self._formula_log is not None:
+            self._formula_log.append((node, term))
+        node.add_formula_term(term)
 
-    def __init__(self):
-        self.nodes_dict = {}
+    def add_nodes(self, nodes):
+        """Add nodes to the nodes set, keeping track of the new ones."""
+        for node in nodes:
+            if node not in self.nodes:
+                self.nodes.add(node)
+                if self.new_nodes is not None:
+                    self.new_nodes.add(node)
+
+    def mark_exported(self):
+        """Record that all of the nodes have been exported.
+
+        Should be called after exporting the nodes set (e.g., with
+        nodes_to_kami), so that the next kami_patch only contains the
+        nodes added after the export.
+        """
+        if self.new_nodes is not None:
+            self.new_nodes = NodeSet()
+
+    def kami_patch(self):
+        """Return a patch to the last export adding the new nodes.
+
+        The patch is a JSON Patch (see nodes_to_kami_patch) containing only
+        the records of the nodes added since the last export, so its cost is
+        proportional to the size of the update. Nodes that were already
+        exported may have changed (e.g., by gaining formula terms), but their
+        Kami records only depend on their names and ancestors, so they do
+        not need to be patched.
+
+        The nodes are marked as exported.
+
+        Raises ValueError if the converter uses a registry, which does not
+        track the new nodes.
+        """
+        if self.new_nodes is None:
+            raise ValueError('New nodes are not tracked with a registry')
+        if self.store is not None:
+            patch = records_to_patch(self.store.kami_records(self.new_nodes))
+        else:
+            patch = nodes_to_kami_patch(self.new_nodes)
+        self.mark_exported()
+        return patch
 
     def get_create_agent(self, name):
         if name in self.nodes_dict:
             return self.nodes_dict[name]
+        elif self.store is not None:
+            agent = self.store.get_create_agent(name)
         else:
             agent = Agent(name)
-            self.nodes_dict[name] = agent
-            return agent
+        self.nodes_dict[name] = agent
+        return agent
+
+    def create_phosphorylation(self, source, target):
+        """Create a Phosphorylation, in the store if there is one, and add it
+        with add_relationship."""
+        if self.store is not None:
+            rel = self.store.add_phosphorylation(source, target)
+        else:
+            rel = Phosphorylation(source, target)
+        return self.add_relationship(rel)
+
+    def add_relationship(self, rel):
+        """Add a relationship, or return the existing one with the same ID.
+
+        IDs are only shared by relationships when stable IDs are in use (see
+        core.use_stable_ids), in which case relationships with the same type
+        and endpoints are identified with each other, and the new one is
+        detached from its endpoints. With a registry, relationships are
+        always detached from their endpoints, which would otherwise keep
+        every agent they connect in memory.
+        """
+        existing = self.relationships.setdefault(rel.id, rel)
+        if existing is not rel or self.registry is not None:
+            rel.detach()
+        return existing
+
+    def site_flag_names(self, mods, positions):
+        """Return the canonical names of the site and flag for modifications.
+
+        The modified residues are normalized to (position, residue) pairs,
+        with numeric positions as integers (so that e.g. '0202' and 202 are
+        the same), and sorted by position with duplicates removed, so that
+        equivalent combinations of residues (e.g. T202 and Y204, or Y204
+        and T202) give the same site. The site name joins the residues, e.g.
+        'T202.Y204', and the flag name the corresponding flag names in the
+        same order, e.g. 'Tphos.Yphos'. Without positions, the site name is
+        None and the flag name joins the sorted distinct flag names.
+
+        The names are interned, and stored in the site_names table, so that
+        equivalent sites and flags are looked up with the same strings.
+
+        Parameters
+        ----------
+        mods : list of string
+            INDRA modification types (e.g., 'PhosphorylationThreonine').
+        positions : list of string or None
+            The positions of the modifications, if known.
+        """
+        key = (tuple(mods), tuple(positions) if positions else None)
+        if key in self.site_names:
+            return self.site_names[key]
+        if positions:
+            residues = sorted(set((_canonical_position(pos), residue_name[mod],
+                                   flag_names[mod])
+                                  for mod, pos in zip(mods, positions)))
+            site_name = intern('.'.join('%s%s' % (residue, pos)
+                                        for pos, residue, _ in residues))
+            flag_name = intern('.'.join(flag for _, _, flag in residues))
+        else:
+            site_name = None
+            flag_name = intern('.'.join(sorted(set(flag_names[mod]
+                                                   for mod in mods))))
+        self.site_names[key] = (site_name, flag_name)
+        return site_name, flag_name
 
     def phosphorylation(self, bp_stmt):
         # Get the names of enzyme and substrate
         enz_agent = self.get_create_agent(bp_stmt.enz.name)
         sub_agent = self.get_create_agent(bp_stmt.sub.name)
         nodes = [enz_agent, sub_agent]
-        # Get the flag name from the modification
-        flag_name = flag_names[bp_stmt.mod]
+        # Get the canonical site and flag names from the modification
+        site_name, flag_name = self.site_flag_names(
+                        [bp_stmt.mod], [bp_stmt.mod_pos] if bp_stmt.mod_pos
+                                                         else None)
         # Do we know the site? If so, create a site for the agent
-        if bp_stmt.mod_pos:
+        if site_name is not None:
             # Does this agent already have a site for this residue?
-            # FIXME This should be canonicalized in some way
-            site_name = '%s%s' % (residue_name[bp_stmt.mod], bp_stmt.mod_pos)
             site = sub_agent.get_create_site(site_name)
             # Add the flag to the site
             flag = site.get_create_flag(flag_name)
@@ -60,19 +381,16 @@ class IndraKamiConverter(object):
             #    flag.formula += ' or %s' % phos.id
 
             # Add edge between enzyme and substrate flag
-            phos = Phosphorylation(enz_agent, flag)
+            phos = self.create_phosphorylation(enz_agent, flag)
             nodes += [site, flag, phos]
         else:
             # Add edge between enzyme and substrate agent
-            phos = Phosphorylation(enz_agent, sub_agent)
+            phos = self.create_phosphorylation(enz_agent, sub_agent)
             # Add the flag to the substrate agent, dependent on the specific
             # phosphorylation relationship
             flag = sub_agent.get_create_flag(flag_name)
-            if flag.formula is None:
-                flag.formula = str(phos.id)
-            else:
-                flag.formula += ' or %s' % phos.id
-            nodes += [flag, phos]
+            self.add_formula_term(flag, str(phos.id))
+            nodes += [phos, flag]
         # Return the 3-4 nodes we've obtained/created
         return nodes
 
@@ -84,16 +402,11 @@ class IndraKamiConverter(object):
         activity_name = '%s_active' % bp_stmt.activity
         active_attr = agent.get_create_attribute(activity_name)
 
-        # FIXME This should be canonicalized in some way
-        site_name = '.'.join(['%s%s' %(residue_name[m],p) \
-                    for m,p in zip(bp_stmt.mod,bp_stmt.mod_pos)])
-        flag_name = '.'.join(flag_names[m] for m in bp_stmt.mod)
-        #site_name = '%s%s' % (residue_name[bp_stmt.mod], bp_stmt.mod_pos)
-        #''.join(['%s%s' %(residue_name[m],p) for m,p in zip(bp_stmt.mod,bp_stmt.mod_pos)])
-        #flag_name = flag_names[bp_stmt.mod]
+        site_name, flag_name = self.site_flag_names(bp_stmt.mod,
+                                                    bp_stmt.mod_pos)
 
         # Get the right statement for the agent/site condition
-        if bp_stmt.mod_pos is None:
+        if site_name is None:
             condition = '%s.%s' % (agent.name, flag_name)
         else:
             condition = '%s.%s.%s' % (agent.name, site_name, flag_name)
@@ -103,98 +416,329 @@ class IndraKamiConverter(object):
         else:
             qualifier = ''
         # Build up the formula
-        if active_attr.formula is None:
-            active_attr.formula = '%s%s' % (qualifier, condition)
-        else:
-            active_attr.formula += ',\\n%s%s' % (qualifier, condition)
+        self.add_formula_term(active_attr, '%s%s' % (qualifier, condition))
         nodes += [active_attr]
         return nodes
 
+    def merge(self, nodes):
+        """Merge nodes built by another converter into this one.
+
+        Agents are unified by name, sites and key residues by their name
+        within the (merged) agent, and flags and attributes by their name
+        within their (merged) parent; relationships are created anew (see
+        add_relationship).
+        The merged objects are created in the order in which the originals
+        were created, so that when the nodes come from successive shards of
+        a statement list, the IDs assigned here are the same as those of a
+        serial conversion of the whole list. Formulas are appended to those
+        of the merged flags and attributes, with the Phosphorylation IDs
+        that they refer to remapped.
+
+        The merged nodes are added to the nodes set.
+
+        Returns the list of merged nodes corresponding to the given nodes.
+        """
+        # Collect the nodes together with all of their ancestors, which are
+        # needed in order to merge them
+        all_nodes = NodeSet()
+        for node in nodes:
+            while node is not None and node not in all_nodes:
+                all_nodes.add(node)
+                node = getattr(node, 'parent', None)
+        merged = {}
+        phos_ids = {}
+
+        def merge_node(node):
+            if node in merged:
+                return merged[node]
+            if isinstance(node, Agent):
+                new_node = self.get_create_agent(node.name)
+            elif isinstance(node, Site):
+                new_node = merge_node(node.parent).get_create_site(node.name)
+            elif isinstance(node, KeyResidue):
+                new_node = merge_node(node.parent).get_create_key_residue(
+                                                                    node.name)
+            elif isinstance(node, Attribute):
+                new_node = merge_node(node.parent).get_create_attribute(
+                                                                    node.name)
+            elif isinstance(node, Flag):
+                new_node = merge_node(node.parent).get_create_flag(node.name)
+            elif isinstance(node, Phosphorylation):
+                new_node = self.create_phosphorylation(
+                                                merge_node(node.source),
+                                                merge_node(node.target))
+                phos_ids[str(node.id)] = str(new_node.id)
+            else:
+                raise ValueError('Cannot merge node %s' % node)
+            merged[node] = new_node
+            return new_node
+
+        for node in sorted(all_nodes, key=_creation_order):
+            merge_node(node)
+        # Now that all of the relationships have been merged, add the
+        # formula terms to the merged flags and attributes
+        for node, new_node in merged.iteritems():
+            if isinstance(node, Flag):
+                for term in node.formula_terms:
+                    new_node.add_formula_term(phos_ids.get(term, term))
+        merged_nodes = [merged[node] for node in nodes]
+        self.add_nodes(merged_nodes)
+        if self.registry is not None:
+            self.registry.trim()
+            self.registry.flush()
+        return merged_nodes
+
+    def convert_parallel(self, stmts, processes=None, shard_size=1000):
+        """Convert statements using a pool of worker processes.
+
+        The statements are split into contiguous shards which are converted
+        independently by the workers, and the resulting nodes are merged
+        into this converter, shard by shard, in the original order. The
+        result is the same as that of a serial conversion with convert.
+
+        Returns the nodes set.
+        """
+        # The statements are counted as they are handed to the workers
+        def counted(stmts):
+            for stmt in stmts:
+                stage.items += 1
+                yield stmt
+
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            with instrumentation.Stage('convert_parallel') as stage:
+                for shard_nodes in pool.imap(convert_statements,
+                                             batches(counted(stmts),
+                                                     shard_size)):
+                    self.merge(shard_nodes)
+        finally:
+            pool.close()
+            pool.join()
+        return self.nodes
+
+def _creation_order(node):
+    """Return the numeric part of a node's ID, which gives its creation order.
+
+    Stable IDs do not depend on the order of creation, so all nodes with
+    stable IDs are given the same position.
+    """
+    try:
+        return int(str(node.id).lstrip('pb'))
+    except ValueError:
+        return 0
+
+def _canonical_position(position):
+    """Return a residue position as an integer if numeric, else a string."""
+    position = str(position).strip()
+    if position.isdigit():
+        return int(position)
+    return position
+
+def convert_statements(stmts, ikc=None):
+    """Convert the statements, returning the list of the converter's nodes.
+
+    If no converter is given, a new IndraKamiConverter is used.
+    """
+    if ikc is None:
+        ikc = IndraKamiConverter()
+    return list(ikc.convert(stmts))
+
 def get_path(source):
-    sub_source = source
-    source_path = []
-    while True:
-        source_path.append(sub_source.id)
-        if sub_source.parent:
-            sub_source = sub_source.parent
-        else:
-            break
-    source_path.reverse()
-    return source_path
+    """Return the (cached) list of IDs from the agent down to the source."""
+    if instrumentation.hook is not None:
+        instrumentation.hook('count', 'get_path', 1)
+    return source.path
 
-def nodes_to_kami(nodes):
-    output = {}
+# The top-level sections of a Kami JSON document, in the order in which they
+# are inserted into the output dict
+kami_sections = ['infos', 'agents', 'regions', 'key_rs', 'attributes',
+                 'flags', 'actions', 'actions_binder', 'edges']
+
+def flag_record(flag, path=None):
+    """Return the (section, record) tuple for a flag or attribute.
+
+    The path of the flag's parent can be passed in if already known.
+    """
+    if path is None:
+        path = get_path(flag.parent)
+    section = 'attributes' if isinstance(flag, Attribute) else 'flags'
+    return (section, {'class': ['node', kami_types[flag.__class__.__name__]],
+                      'name': flag.id,
+                      'label': flag.name,
+                      'dest_class': ['node',
+                                     kami_types[flag.parent.__class__.__name__]],
+                      'dest_path': path,
+                      'values': [], # FIXME
+                      'v_equiv': None})
+
+class KamiRecordBuilder(object):
+    """Builds the Kami JSON records of nodes, for a single export.
+
+    The parts of records that are the same for many records are only built
+    once per builder and shared between the records: in particular, the
+    context of each component (the context elements for it and its
+    ancestors) is shared by all of the actions in which it takes part, and
+    the class lists by all of the records of a section. The records should
+    therefore be copied (e.g., with copy.deepcopy) before being modified.
 
-    # Compile list of agents
-    agent_list = []
-    site_list = []
-    key_rs_list = []
-    attributes_list = []
-    flags_list = []
-    actions_list = []
-    actions_binder_list = []
-    edges_list = []
-
-    def add_flags_attributes(node, path):
-        node_class = kami_types[node.__class__.__name__]
-        for flag_name, flag_obj in node.flags.iteritems():
-            flags_list.append({'class': ['node', 'flag'],
-                               'name': flag_obj.id,
-                               'label': flag_name,
-                               'dest_class': ['node', node_class],
-                               'dest_path': path,
-                               'values': [], # FIXME
-                               'v_equiv': None})
-        for attr_name, attr_obj in node.attributes.iteritems():
-            attributes_list.append({'class': ['node', 'attr'],
-                               'name': attr_obj.id,
-                               'label': attr_name,
-                               'dest_class': ['node', node_class],
-                               'dest_path': path,
-                               'values': [], # FIXME
-                               'v_equiv': None})
+    Parameters
+    ----------
+    max_contexts : int
+        If given, the contexts kept are cleared whenever there are more than
+        this many, so that the memory used by the builder is bounded.
+    """
+    def __init__(self, max_contexts=None):
+        self.max_contexts = max_contexts
+        self.binder_class = ['node', 'binder']
+        self.left_binder = {'class': self.binder_class, 'name': 'left'}
+        self.right_binder = {'class': self.binder_class, 'name': 'right'}
+        self.edge_class = ['edge']
+        self.action_class = ['node', 'action', 'mod']
+        self.node_classes = dict((type_name, ['node', kami_type])
+                                 for type_name, kami_type in
+                                 kami_types.iteritems())
+        # The context of each component, by component ID (so that the
+        # components themselves are not kept)
+        self.contexts = {}
 
+    def ancestor_context(self, node):
+        """Return the context elements for the node and its ancestors."""
+        context = self.contexts.get(node.id)
+        if context is None:
+            node_class = self.node_classes[node.__class__.__name__]
+            element = {'el_cl': node_class, 'el_path': get_path(node)}
+            if node_class[1] == 'flag' or node_class[1] == 'attr':
+                element['el_value'] = ['unphos']
+            context = [element]
+            if node.parent:
+                context += self.ancestor_context(node.parent)
+            if self.max_contexts is not None and \
+               len(self.contexts) >= self.max_contexts:
+                self.contexts.clear()
+            self.contexts[node.id] = context
+        return context
+
+    def agent(self, node):
+        if instrumentation.hook is not None:
+            instrumentation.hook('trace', 'agent', node)
+        return {'class':['node', 'agent'],
+                'name':node.id,
+                'label': node.name,
+                'cx':None,
+                'cy':None,
+                'family':None,
+                'abstract':False}
+
+    def region(self, node):
+        return {'class': ['node', 'region'],
+                'name': node.id,
+                'label': node.name,
+                'ag_name': node.parent.id,
+                'color': None}
+
+    def flags_attributes(self, node):
+        """Generate the (section, record) tuples of the flags and
+        attributes of a component."""
+        path = get_path(node)
+        for flag_obj in node.flags.itervalues():
+            yield flag_record(flag_obj, path)
+        for attr_obj in node.attributes.itervalues():
+            yield flag_record(attr_obj, path)
+
+    def binders(self, node):
+        """Return the left and right binder records of a Phosphorylation."""
+        if instrumentation.hook is not None:
+            instrumentation.hook('trace', 'phosphorylation', node)
+        left = dict(self.left_binder)
+        left['act_name'] = node.id
+        right = dict(self.right_binder)
+        right['act_name'] = node.id
+        return [left, right]
+
+    def edge(self, node):
+        return {'class': self.edge_class,
+                'in_class': self.binder_class,
+                'in_path': [node.id, 'right'],
+                'out_class': self.node_classes[node.target.__class__.__name__],
+                'out_path': get_path(node.target)}
+
+    def action(self, node):
+        # Treat the enzyme and substrate the same, with the contexts of both
+        # and all of their parents
+        return {'class': self.action_class,
+                'name': node.id,
+                'label': node.id,
+                'context': self.ancestor_context(node.source) +
+                           self.ancestor_context(node.target)}
+
+def _columnar(nodes):
+    """Return the columnar.ColumnarGraph storing the nodes, if they are a
+    ColumnarGraph or ColumnarNode views of its rows (e.g., the nodes of an
+    IndraKamiConverter with a store), or None, along with the nodes.
+
+    The first of the nodes is read to tell views from core nodes, so if the
+    nodes are an iterator, an iterator over all of them is returned in its
+    place.
+    """
+    if isinstance(nodes, ColumnarGraph):
+        return nodes, nodes
+    iterator = iter(nodes)
+    first = next(iterator, None)
+    if iterator is nodes and first is not None:
+        nodes = itertools.chain([first], iterator)
+    if isinstance(first, ColumnarNode):
+        return first.graph, nodes
+    return None, nodes
+
+def kami_records(nodes):
+    """Generate the Kami JSON records for the given nodes one at a time.
+
+    Yields (section, record) tuples, where section is the name of the
+    top-level list in the Kami JSON output (e.g., 'agents', 'edges') to
+    which the record belongs. Records for each section are generated in the
+    order in which the nodes are visited. The records share some of their
+    parts (see KamiRecordBuilder).
+
+    The nodes can also be a columnar.ColumnarGraph, in which case the
+    records of the whole model are generated from its columns, or views of
+    its rows, whose records are generated from its columns in the same way.
+    Collections of nodes with a max_contexts attribute (see agent_registry)
+    bound the contexts kept by the KamiRecordBuilder.
+    """
+    builder = KamiRecordBuilder(getattr(nodes, 'max_contexts', None))
+    graph, nodes = _columnar(nodes)
+    if graph is not None:
+        for record in graph.kami_records(None if nodes is graph else nodes):
+            yield record
+        return
+
+    yield ('infos', {'scale':1, 'center':'A'})
 
     for node in nodes:
         # AGENTS
         if isinstance(node, Agent):
-            print "agent", node.name
-            agent_list.append({'class':['node', 'agent'],
-                               'name':node.id,
-                               'label': node.name,
-                               'cx':None,
-                               'cy':None,
-                               'family':None,
-                               'abstract':False})
-            add_flags_attributes(node, get_path(node))
+            yield ('agents', builder.agent(node))
+            for record in builder.flags_attributes(node):
+                yield record
         # SITES
         if isinstance(node, Site):
-            site_list.append({'class': ['node', 'region'],
-                              'name': node.id,
-                              'label': node.name,
-                              'ag_name': node.parent.id,
-                              'color': None})
-            add_flags_attributes(node, get_path(node))
+            yield ('regions', builder.region(node))
+            for record in builder.flags_attributes(node):
+                yield record
         # KEY RESIDUES
         if isinstance(node, KeyResidue):
             # If this node belongs to a region, 
             if isinstance(node.parent, Site):
                 assert isinstance(node.parent.parent, Agent)
-                region_name = node.parent.id
-                ag_name = node.parent.parent.id
             # Otherwise, we should belong to an Agent
             else:
                 assert isinstance(node.parent, Agent)
-                ag_name = node.parent.id
-                region_name = None
 
-            key_rs_list.append({'class': ['node', 'key_r'],
-                                'name': node.id,
-                                'label': node.name,
-                                'ag_name': ag_name,
-                                'region_name': region_name,
-                                'angle': None})
-            add_flags_attributes(node, get_path(node))
+            # Key residues are not (yet) included in the output, but their
+            # flags and attributes are
+            for record in builder.flags_attributes(node):
+                yield record
 
             # Get flags/attributes for agent
             # Iterate over sites
@@ -205,86 +749,321 @@ def nodes_to_kami(nodes):
             # For each keyr, get flags/attributes
         # ACTIONS
         if isinstance(node, Phosphorylation):
-            print "phosphorylation", node.source, node.target
-            phos_action_binder = [{'class': ['node', 'binder'],
-                                   'name': 'left',
-                                   'act_name': node.id},
-                                  {'class': ['node', 'binder'],
-                                   'name': 'right',
-                                   'act_name': node.id}]
-            actions_binder_list += phos_action_binder
-
+            for binder in builder.binders(node):
+                yield ('actions_binder', binder)
             # EDGES LIST
-            edges_list.append({
-                        'class': ['edge'],
-                        'in_class': ['node', 'binder'],
-                        'in_path': [node.id, 'right'],
-                        'out_class': ['node',
-                                      kami_types[node.target.__class__.__name__]],
-                        'out_path': get_path(node.target)})
-
-            # Treat the enzyme and substrate the same
-            context_list = []
-            for source in [node.source, node.target]:
-
-                # Build context for this node and all of its parents
-                while True:
-                    source_type = kami_types[source.__class__.__name__]
-                    # Get the path to this node
-                    source_path = get_path(source)
-                    context = {'el_cl': ['node', source_type],
-                               'el_path': source_path}
-
-                    if source_type == 'flag' or \
-                       source_type == 'attr':
-                        context['el_value'] = ['unphos']
-                    context_list.append(context)
-
-                    # Go up the hierarchy for the next node
-                    if source.parent:
-                        source = source.parent
-                    else:
-                        break
-
-            actions_list.append({'class': ['node', 'action', 'mod'],
-                                'name': node.id,
-                                'label': node.id,
-                                'context': context_list})
-
-    output['infos'] = [{'scale':1, 'center':'A'}]
-    output['agents'] = agent_list
-    output['regions'] = site_list
-    output['key_rs'] = []
-    output['attributes'] = attributes_list
-    output['flags'] = flags_list
-    output['actions'] = actions_list
-    output['actions_binder'] = actions_binder_list
-    output['edges'] = edges_list
-
-    #json_str = json.dumps(output, indent=2)
+            yield ('edges', builder.edge(node))
+            yield ('actions', builder.action(node))
 
+def nodes_to_kami(nodes):
+    output = {}
+    for section in kami_sections:
+        output[section] = []
+    with instrumentation.Stage('nodes_to_kami') as stage:
+        for section, record in kami_records(nodes):
+            output[section].append(record)
+            stage.items += 1
     return output
 
-if __name__ == '__main__':
-    with open(sys.argv[1]) as f:
-        bps = pickle.load(f)
+class KamiExport(object):
+    """Lazy view of the Kami JSON of nodes, computed section by section.
+
+    Each section (e.g., export['agents']) is only computed when it is first
+    accessed, and then kept, so reading a few sections only costs what is
+    needed for those: e.g., the agents and actions of a summary do not need
+    the binders and edges, and the flags and attributes of a state panel do
+    not need the actions at all.
+
+    Parameters
+    ----------
+    nodes : iterable of nodes
+        The nodes to export, as for nodes_to_kami. They are read once, when
+        the first section is computed. A columnar.ColumnarGraph (or views of
+        its rows) can also be exported, but all of its sections are computed
+        together.
+    sections : list of string
+        The sections to export; defaults to all of kami_sections. Sections
+        that are not exported are absent from the view.
+    agents : list of string
+        The names of the agents to export; if given, only the nodes
+        contained in these agents, and the relationships between them, are
+        exported.
+    """
+    def __init__(self, nodes, sections=None, agents=None):
+        self.nodes = nodes
+        self.sections = list(sections) if sections is not None \
+                                       else list(kami_sections)
+        for section in self.sections:
+            if section not in kami_sections:
+                raise KeyError(section)
+        self.agents = set(agents) if agents is not None else None
+        if self.agents is not None and isinstance(nodes, ColumnarGraph):
+            raise ValueError('Agents cannot be selected from a ColumnarGraph')
+        self._output = {}
+        self._builder = KamiRecordBuilder()
+        self._partition = None
+        # Whether the nodes are stored in a ColumnarGraph, once known
+        self._is_columnar = None
+
+    def _columnar(self):
+        """Return whether the nodes are stored in a ColumnarGraph, reading
+        the first of them to find out (see _columnar)."""
+        if self._is_columnar is None:
+            graph, self.nodes = _columnar(self.nodes)
+            self._is_columnar = graph is not None
+            if self._is_columnar and self.agents is not None:
+                raise ValueError('Agents cannot be selected from a '
+                                 'ColumnarGraph')
+        return self._is_columnar
+
+    def _nodes_by_type(self):
+        """Return the components in order, and the phosphorylations, of
+        the exported agents."""
+        if self._partition is None:
+            components = []
+            phosphorylations = []
+            agent_ids = None
+            nodes = self.nodes
+            if self.agents is not None:
+                nodes = list(nodes)
+                agent_ids = set(node.id for node in nodes
+                                if isinstance(node, Agent) and
+                                   node.name in self.agents)
+            for node in nodes:
+                if isinstance(node, Component):
+                    if agent_ids is None or get_path(node)[0] in agent_ids:
+                        components.append(node)
+                elif isinstance(node, Phosphorylation):
+                    if agent_ids is None or \
+                       all(agent.id in agent_ids
+                           for agent in node.endpoint_agents()):
+                        phosphorylations.append(node)
+            self._partition = (components, phosphorylations)
+        return self._partition
+
+    def _compute(self, section):
+        """Return the records of a section."""
+        if section == 'infos':
+            return [{'scale':1, 'center':'A'}]
+        components, phosphorylations = self._nodes_by_type()
+        builder = self._builder
+        if section == 'agents':
+            return [builder.agent(node) for node in components
+                    if isinstance(node, Agent)]
+        if section == 'regions':
+            return [builder.region(node) for node in components
+                    if isinstance(node, Site)]
+        if section == 'flags' or section == 'attributes':
+            return [record for node in components
+                    for record_section, record in
+                    builder.flags_attributes(node)
+                    if record_section == section]
+        if section == 'actions_binder':
+            return [binder for node in phosphorylations
+                    for binder in builder.binders(node)]
+        if section == 'edges':
+            return [builder.edge(node) for node in phosphorylations]
+        if section == 'actions':
+            return [builder.action(node) for node in phosphorylations]
+        # Sections without records (key_rs)
+        return []
+
+    def __getitem__(self, section):
+        if section not in self.sections:
+            raise KeyError(section)
+        if section not in self._output:
+            if self._columnar():
+                self._compute_columnar()
+            else:
+                with instrumentation.Stage('export.' + section) as stage:
+                    self._output[section] = self._compute(section)
+                    stage.items = len(self._output[section])
+        return self._output[section]
+
+    def _compute_columnar(self):
+        for section in kami_sections:
+            self._output[section] = []
+        for section, record in kami_records(self.nodes):
+            self._output[section].append(record)
+
+    def __contains__(self, section):
+        return section in self.sections
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def keys(self):
+        return list(self.sections)
+
+    def computed(self):
+        """Return the names of the sections computed so far."""
+        return [section for section in self.sections
+                if section in self._output]
 
-    ikc = IndraKamiConverter()
+    def to_dict(self):
+        """Return a dict of all of the exported sections, computing them if
+        necessary, in the same form as nodes_to_kami."""
+        output = {}
+        for section in self.sections:
+            output[section] = self[section]
+        return output
 
-    nodes = set([])
-    for stmt in bps:
-        if isinstance(stmt, indra.statements.Phosphorylation):
-            new_nodes = ikc.phosphorylation(stmt)
-            nodes.update(new_nodes)
-        elif isinstance(stmt, indra.statements.ActivityModification):
-            new_nodes = ikc.activity_modification(stmt)
-            nodes.update(new_nodes)
+def nodes_to_kami_patch(nodes):
+    """Return a JSON Patch adding the records for the nodes to a Kami JSON.
 
-    output = nodes_to_kami(nodes)
+    The patch (RFC 6902) is a list of operations appending the records to
+    the sections of the Kami JSON (e.g., {'op': 'add', 'path': '/agents/-',
+    'value': {...}}); it can be applied with apply_kami_patch.
+    """
+    nodes = NodeSet(nodes)
+    records = list(kami_records(nodes))
+    # Flags and attributes are exported along with their parents, so those
+    # added to nodes that are not being exported need records of their own
+    records.extend(flag_record(node) for node in nodes
+                   if isinstance(node, Flag) and node.parent not in nodes)
+    return records_to_patch(records)
 
-    with open('kami.json', 'w') as f:
-        f.write(json_str)
+def records_to_patch(records):
+    """Return the JSON Patch adding the (section, record) tuples."""
+    return [{'op': 'add', 'path': '/%s/-' % section, 'value': record}
+            for section, record in records
+            if section != 'infos']
 
-    #kg = Graph('example_graph', nodes=nodes)
-    #kg.render()
-    #kg.write()
+def apply_kami_patch(output, patch):
+    """Apply a patch from nodes_to_kami_patch to a Kami JSON dict in place.
+    """
+    for operation in patch:
+        section = operation['path'].split('/')[1]
+        if operation['op'] != 'add' or \
+           operation['path'] != '/%s/-' % section:
+            raise ValueError('Unsupported patch operation: %s' % operation)
+        output[section].append(operation['value'])
+    return output
+
+def write_kami(nodes, f):
+    """Stream the Kami JSON for the given nodes to a file object.
+
+    Produces exactly the same text as json.dumps(nodes_to_kami(nodes),
+    indent=2), but without holding the whole document in memory: each record
+    is serialized as soon as it is generated and spooled to a temporary file
+    for its section, and the sections are then copied to f in turn.
+    """
+    # Build an (empty) output dict the same way nodes_to_kami does so that
+    # the sections come out in the same order as json.dumps would give
+    skeleton = {}
+    for section in kami_sections:
+        skeleton[section] = None
+    encoder = json.JSONEncoder(indent=2)
+    item_sep = encoder.item_separator
+    key_sep = encoder.key_separator
+    # Records are nested two levels deep: in a list, inside the output dict
+    record_indent = '\n' + ' ' * 4
+    import tempfile
+    spools = dict((section, tempfile.TemporaryFile())
+                  for section in kami_sections)
+    counts = dict((section, 0) for section in kami_sections)
+    try:
+        with instrumentation.Stage('write_kami') as stage:
+            for section, record in kami_records(nodes):
+                spool = spools[section]
+                if counts[section]:
+                    spool.write(item_sep)
+                spool.write(record_indent)
+                spool.write(encoder.encode(record).replace('\n',
+                                                          record_indent))
+                counts[section] += 1
+
+            f.write('{')
+            for i, section in enumerate(skeleton):
+                if i:
+                    f.write(item_sep)
+                f.write('\n  %s%s[' % (encoder.encode(section), key_sep))
+                if counts[section]:
+                    spool = spools[section]
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, f)
+                    f.write('\n  ')
+                f.write(']')
+            f.write('\n}')
+            stage.items = sum(counts.values())
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+def main(argv=None):
+    """Convert files of INDRA statements into a Kami JSON file.
+
+    The statement files are pickle streams or JSONL files (see readers), and
+    are converted in order. Only the modules needed for the conversion are
+    loaded: the INDRA statement classes when the statements are read, but
+    neither pygraphviz nor the INDRA readers, so that short conversion jobs
+    start quickly.
+
+    Parameters
+    ----------
+    argv : list of string
+        The command line arguments, without the program name; defaults to
+        sys.argv[1:].
+
+    Returns the exit status.
+    """
+    import optparse
+    parser = optparse.OptionParser(
+                    usage='%prog [options] statements [statements ...]')
+    parser.add_option('-o', '--output', default='kami.json',
+                      help='the Kami JSON file to write, or - for the '
+                           'standard output (default: kami.json)')
+    parser.add_option('-p', '--processes', type='int',
+                      help='the number of worker processes converting the '
+                           'statements (default: convert serially)')
+    parser.add_option('-c', '--cache',
+                      help='the conversion cache database to use (see '
+                           'conversion_cache)')
+    parser.add_option('-r', '--registry',
+                      help='keep the agents in this database rather than in '
+                           'memory, for models larger than memory (see '
+                           'agent_registry); the model already in the '
+                           'database is kept, and the statements are added '
+                           'to it')
+    parser.add_option('--stable-ids', action='store_true',
+                      help='use stable IDs (see core.use_stable_ids)')
+    options, filenames = parser.parse_args(argv)
+    if not filenames:
+        parser.error('no statement files given')
+    if options.stable_ids:
+        use_stable_ids()
+    cache = None
+    if options.cache:
+        from conversion_cache import ConversionCache
+        cache = ConversionCache(options.cache)
+    registry = None
+    if options.registry:
+        from agent_registry import DiskAgentRegistry
+        registry = DiskAgentRegistry(options.registry)
+    ikc = IndraKamiConverter(cache=cache, registry=registry)
+
+    # The statements are read incrementally (see readers)
+    def statements():
+        for filename in filenames:
+            for stmt in read_statements(filename):
+                yield stmt
+
+    if options.processes:
+        ikc.convert_parallel(statements(), processes=options.processes)
+    else:
+        for batch in batches(statements(), 1000):
+            ikc.convert(batch)
+
+    if options.output == '-':
+        write_kami(ikc.nodes, sys.stdout)
+    else:
+        with open(options.output, 'w') as f:
+            write_kami(ikc.nodes, f)
+    if cache is not None:
+        cache.close()
+    if registry is not None:
+        registry.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
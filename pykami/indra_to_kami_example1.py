@@ -1,22 +1,25 @@
-from indra.biopax import biopax_api
-from indra.trips import trips_api
 from indra_to_kami import nodes_to_kami, IndraKamiConverter
-import indra.statements
+from pipeline import IngestionPipeline
 import json
 
 # Get a biopax processor from a biopax query
+#from indra.biopax import biopax_api
 #bp = biopax_api.process_pc_pathsfromto(['BRAF'], ['MAP2K1'])
 #bp.get_phosphorylation()
 
-tp = trips_api.process_text('MEK2 phosphorylates ERK1 at Thr-202 and Tyr-204')
+def read_example():
+    """Read the example sentence with TRIPS, returning the statements."""
+    # The TRIPS API is only loaded by the process reading the text
+    from indra.trips import trips_api
+    tp = trips_api.process_text('MEK2 phosphorylates ERK1 at Thr-202 and '
+                                'Tyr-204')
+    return tp.statements
 
 ikc = IndraKamiConverter()
-nodes = set([])
-# Collect the nodes to generate from the INDRA statements
-for stmt in tp.statements:
-    if isinstance(stmt, indra.statements.Phosphorylation):
-        new_nodes = ikc.phosphorylation(stmt)
-        nodes.update(new_nodes)
+# Collect the nodes to generate from the INDRA statements, reading them in a
+# separate process (further sources, e.g. pickle files of statements, can be
+# added to the list and are read concurrently)
+nodes = IngestionPipeline([read_example], ikc).run()
 
 # Create the JSON output
 output = nodes_to_kami(nodes)
@@ -0,0 +1,137 @@
+"""Instrumentation of conversion, export and rendering.
+
+The converter, the exporters and Graph.render report what they do to a
+hook, a callable installed with set_hook, which is called as
+
+    hook(event, name, value)
+
+with one of the events:
+
+'count'
+    A counter was incremented by value, e.g. ('count', 'nodes.Agent', 1)
+    when an agent is created. The counters are 'nodes.<type>' for each
+    type of node created, 'get_path' for the paths looked up while
+    exporting, and 'formula_appends' for the terms added to formulas.
+'stage'
+    A stage finished, and value is a (seconds, items) tuple giving its wall
+    time and the number of items it processed: statements for 'convert',
+    'convert_parallel' and 'ingest' (see pipeline), records for
+    'nodes_to_kami', 'write_kami' and 'export.<section>' (see KamiExport),
+    and agents for 'render'.
+'trace'
+    A node was visited, e.g. ('trace', 'agent', agent) when an agent is
+    exported.
+
+When no hook is installed (the default), the instrumented code only checks
+that the hook is None, so instrumentation costs next to nothing. Code
+reporting counts in tight loops should check instrumentation.hook itself
+rather than calling count.
+"""
+import time
+
+# The installed hook, or None if instrumentation is disabled
+hook = None
+
+def set_hook(new_hook):
+    """Install a hook, or disable instrumentation with None.
+
+    Returns the previously installed hook.
+    """
+    global hook
+    previous = hook
+    hook = new_hook
+    return previous
+
+def count(name, n=1):
+    """Report an increment of a counter to the hook, if any."""
+    if hook is not None:
+        hook('count', name, n)
+
+def trace(name, value):
+    """Report a visited node to the hook, if any."""
+    if hook is not None:
+        hook('trace', name, value)
+
+
+class Stage(object):
+    """Context manager timing a stage and reporting it to the hook.
+
+    The number of items processed should be stored in the items attribute
+    before the stage ends. Nothing is timed if no hook is installed when
+    the stage starts.
+
+    Parameters
+    ----------
+    name : string
+        The name of the stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.start = None
+
+    def __enter__(self):
+        if hook is not None:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None and hook is not None:
+            hook('stage', self.name, (time.time() - self.start, self.items))
+
+
+class Collector(object):
+    """A hook accumulating the counters and stage timings.
+
+    Parameters
+    ----------
+    keep_traces : bool
+        Whether to keep the traced nodes (which may be many).
+
+    Attributes
+    ----------
+    counts : dict
+        The total of each counter.
+    times : dict
+        The total wall time of each stage, in seconds.
+    items : dict
+        The total number of items processed by each stage.
+    traces : list
+        The (name, node) tuples traced, if keep_traces is set.
+    """
+    def __init__(self, keep_traces=False):
+        self.keep_traces = keep_traces
+        self.counts = {}
+        self.times = {}
+        self.items = {}
+        self.traces = []
+
+    def __call__(self, event, name, value):
+        if event == 'count':
+            self.counts[name] = self.counts.get(name, 0) + value
+        elif event == 'stage':
+            seconds, items = value
+            self.times[name] = self.times.get(name, 0.) + seconds
+            self.items[name] = self.items.get(name, 0) + items
+        elif event == 'trace' and self.keep_traces:
+            self.traces.append((name, value))
+
+    def rate(self, stage):
+        """Return the items processed per second by the stage (e.g.
+        statements per second for 'convert'), or None if not timed."""
+        seconds = self.times.get(stage)
+        if not seconds:
+            return None
+        return self.items[stage] / seconds
+
+    def report(self):
+        """Return a summary of the stages and counters as a string."""
+        lines = []
+        for stage in sorted(self.times):
+            rate = self.rate(stage)
+            lines.append('%-20s %10.3f s %10d items %12s/s' %
+                         (stage, self.times[stage], self.items[stage],
+                          '%.1f' % rate if rate is not None else '-'))
+        for name in sorted(self.counts):
+            lines.append('%-20s %10d' % (name, self.counts[name]))
+        return '\n'.join(lines)
@@ -0,0 +1,163 @@
+"""Merge of Kami JSON documents, e.g. from shards of a corpus.
+
+The documents (as written by nodes_to_kami or write_kami) are merged one at
+a time into a single document, in a single pass over the records of each:
+
+- agents are unified by label;
+- regions (and key residues) by agent and label;
+- flags and attributes by the path of the node they belong to and label;
+- actions by class and endpoints (the paths of their source and target),
+  along with their binders and edges.
+
+All of the records are given new IDs in the merged document, and every
+reference to an ID (ag_name, dest_path, act_name, in_path, out_path and the
+el_path of the context elements) is remapped. Records are looked up in hash
+indexes of the records merged so far, so merging takes time linear in the
+total size of the documents, and only one input document needs to be in
+memory at a time.
+
+Usage: python kami_merge.py merged.json shard1.json shard2.json ...
+"""
+import re
+import sys
+import json
+
+# The order in which the sections are merged, so that every record is
+# merged after the records it refers to
+merge_order = ['infos', 'agents', 'regions', 'key_rs', 'flags', 'attributes',
+               'actions', 'actions_binder', 'edges']
+
+_prefix_re = re.compile(r'^([^\d]*)\d+$')
+
+
+class KamiMerger(object):
+    """Merges Kami JSON documents into one, added one at a time.
+
+    Attributes
+    ----------
+    output : dict
+        The merged Kami JSON document.
+    """
+    def __init__(self):
+        self.output = dict((section, []) for section in merge_order)
+        self.output['infos'] = None
+        # The ID of each merged record, by the key identifying it
+        self._index = {}
+        self._next_id = 0
+
+    def new_id(self, old_id=None):
+        """Return a new ID, with the prefix of the old ID (e.g. 'p')."""
+        self._next_id += 1
+        if isinstance(old_id, basestring):
+            match = _prefix_re.match(old_id)
+            if match is not None and match.group(1):
+                return '%s%d' % (match.group(1), self._next_id)
+        return self._next_id
+
+    def add(self, document):
+        """Merge a document (a dict) into the output."""
+        # The new ID of each ID of the document
+        ids = {}
+
+        def remap(old_id):
+            # IDs of records not in the document (e.g. key residues, which
+            # are not exported) are given new IDs of their own
+            if old_id not in ids:
+                ids[old_id] = self.new_id(old_id)
+            return ids[old_id]
+
+        def remap_path(path):
+            return [remap(old_id) for old_id in path]
+
+        def unify(key, record):
+            """Map the record's ID to that of the merged record with the
+            key, adding the record if there is none. Returns the new record
+            if added, or None."""
+            new_id = self._index.get(key)
+            if new_id is not None:
+                ids[record['name']] = new_id
+                return None
+            new_id = self.new_id(record['name'])
+            ids[record['name']] = new_id
+            self._index[key] = new_id
+            new_record = dict(record)
+            new_record['name'] = new_id
+            return new_record
+
+        if self.output['infos'] is None:
+            self.output['infos'] = document.get('infos', [])
+        for record in document.get('agents', ()):
+            new_record = unify(('agents', record['label']), record)
+            if new_record is not None:
+                self.output['agents'].append(new_record)
+        for section in ('regions', 'key_rs'):
+            for record in document.get(section, ()):
+                ag_name = remap(record['ag_name'])
+                new_record = unify((section, ag_name, record['label']),
+                                   record)
+                if new_record is not None:
+                    new_record['ag_name'] = ag_name
+                    self.output[section].append(new_record)
+        for section in ('flags', 'attributes'):
+            for record in document.get(section, ()):
+                dest_path = remap_path(record['dest_path'])
+                new_record = unify((section, tuple(dest_path),
+                                    record['label']), record)
+                if new_record is not None:
+                    new_record['dest_path'] = dest_path
+                    self.output[section].append(new_record)
+        # Actions are identified by their endpoints: the source is the
+        # first element of the context, and the target the first element
+        # after the source and its ancestors (ending with the agent)
+        merged_actions = set([])
+        for record in document.get('actions', ()):
+            context = [dict(element, el_path=remap_path(element['el_path']))
+                       for element in record['context']]
+            endpoints = [tuple(context[0]['el_path'])] if context else []
+            for previous, element in zip(context, context[1:]):
+                if len(previous['el_path']) == 1:
+                    endpoints.append(tuple(element['el_path']))
+                    break
+            old_id = record['name']
+            new_record = unify(('actions', tuple(record['class']),
+                                tuple(endpoints)), record)
+            if new_record is not None:
+                if record.get('label') == old_id:
+                    new_record['label'] = new_record['name']
+                new_record['context'] = context
+                self.output['actions'].append(new_record)
+                merged_actions.add(old_id)
+        # The binders and edges of actions unified with ones already merged
+        # are already there too
+        for record in document.get('actions_binder', ()):
+            if record['act_name'] in merged_actions:
+                new_record = dict(record)
+                new_record['act_name'] = remap(record['act_name'])
+                self.output['actions_binder'].append(new_record)
+        for record in document.get('edges', ()):
+            if record['in_path'][0] in merged_actions:
+                new_record = dict(record)
+                new_record['in_path'] = [remap(record['in_path'][0])] + \
+                                        record['in_path'][1:]
+                new_record['out_path'] = remap_path(record['out_path'])
+                self.output['edges'].append(new_record)
+
+def merge_kami(documents):
+    """Merge Kami JSON documents (dicts), returning the merged document."""
+    merger = KamiMerger()
+    for document in documents:
+        merger.add(document)
+    return merger.output
+
+def merge_kami_files(filenames):
+    """Merge the Kami JSON files, loading one at a time."""
+    def documents():
+        for filename in filenames:
+            with open(filename) as f:
+                yield json.load(f)
+    return merge_kami(documents())
+
+if __name__ == '__main__':
+    merged = merge_kami_files(sys.argv[2:])
+    with open(sys.argv[1], 'w') as f:
+        json.dump(merged, f, indent=2)
@@ -0,0 +1,179 @@
+"""Concurrent ingestion of statements from several sources.
+
+An IngestionPipeline reads statements from any number of sources at once,
+each in its own reader process (or thread), and hands them over in batches
+through a bounded queue to an IndraKamiConverter in the calling process.
+Reading and conversion overlap: a slow source does not hold up the
+conversion of the batches of the others, and the conversion does not hold
+up reading, except that the readers block when the queue is full, so that
+no more than max_batches batches are ever waiting to be converted.
+
+Sources are either file names, read with readers.read_statements (pickle
+streams or JSONL files), or callables returning an iterable of statements,
+e.g. a function calling a reader such as TRIPS on some text. With reader
+processes, callables must be picklable (e.g., module-level functions).
+
+The batches of different sources are converted in the order in which they
+arrive, so the IDs assigned to the nodes may differ between runs (stable
+IDs do not, see core.use_stable_ids).
+"""
+import Queue
+import threading
+import traceback
+import multiprocessing
+import instrumentation
+from readers import batches, read_statements
+
+def _statements(source):
+    """Return an iterable of the statements of a source."""
+    if isinstance(source, basestring):
+        return read_statements(source)
+    return source()
+
+def _put(queue, item, stop):
+    """Put an item on the queue, waiting until there is room unless stopped.
+
+    Returns False if stopped before the item could be put.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _drain(queue):
+    """Discard the items on the queue."""
+    try:
+        while True:
+            queue.get_nowait()
+    except Queue.Empty:
+        pass
+
+def _stopped_reader(readers, finished):
+    """Return the index of a reader that has stopped without putting 'done'
+    or 'error' (e.g., a reader process killed, or exiting with os._exit), or
+    None if there is none."""
+    for index, reader in enumerate(readers):
+        if index not in finished and not reader.is_alive():
+            return index
+    return None
+
+def _read_source(index, source, queue, stop, batch_size):
+    """Read the statements of a source onto the queue, in batches.
+
+    Puts ('batch', index, statements) items, followed by ('done', index,
+    None), or ('error', index, traceback) if reading fails.
+    """
+    try:
+        for batch in batches(_statements(source), batch_size):
+            if not _put(queue, ('batch', index, batch), stop):
+                return
+        _put(queue, ('done', index, None), stop)
+    except Exception:
+        _put(queue, ('error', index, traceback.format_exc()), stop)
+
+
+class IngestionPipeline(object):
+    """Converts statements read concurrently from several sources.
+
+    Parameters
+    ----------
+    sources : list
+        The sources of statements: file names or callables (see the
+        module documentation).
+    converter : IndraKamiConverter
+        The converter to which the statements are handed. If not given, a
+        new IndraKamiConverter is created.
+    batch_size : int
+        The number of statements handed over to the converter at a time.
+    max_batches : int
+        The maximum number of batches waiting in the queue.
+    processes : bool
+        Whether to run the readers in processes rather than threads.
+        Processes read and deserialize statements in parallel with the
+        conversion; threads avoid copying the statements between processes,
+        but only overlap I/O with the conversion.
+
+    Attributes
+    ----------
+    counts : list of int
+        The number of statements read from each source.
+    """
+    def __init__(self, sources, converter=None, batch_size=1000,
+                 max_batches=8, processes=True):
+        if converter is None:
+            from indra_to_kami import IndraKamiConverter
+            converter = IndraKamiConverter()
+        self.sources = list(sources)
+        self.converter = converter
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.processes = processes
+        self.counts = [0] * len(self.sources)
+
+    def run(self):
+        """Read and convert all of the statements of the sources.
+
+        Raises RuntimeError, after stopping the other readers, if reading a
+        source fails, or if a reader stops without reporting (e.g., a reader
+        process killed).
+
+        Returns the converter's nodes set.
+        """
+        if self.processes:
+            queue = multiprocessing.Queue(self.max_batches)
+            stop = multiprocessing.Event()
+            worker = multiprocessing.Process
+        else:
+            queue = Queue.Queue(self.max_batches)
+            stop = threading.Event()
+            worker = threading.Thread
+        readers = [worker(target=_read_source,
+                          args=(index, source, queue, stop, self.batch_size))
+                   for index, source in enumerate(self.sources)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        # The readers that have put 'done'
+        finished = set()
+        try:
+            with instrumentation.Stage('ingest') as stage:
+                while len(finished) < len(readers):
+                    try:
+                        kind, index, value = queue.get(timeout=0.1)
+                    except Queue.Empty:
+                        stopped = _stopped_reader(readers, finished)
+                        if stopped is None:
+                            continue
+                        # The items put by a reader are all on the queue
+                        # once it has stopped, so it failed if none is left
+                        try:
+                            kind, index, value = queue.get_nowait()
+                        except Queue.Empty:
+                            raise RuntimeError(
+                                    'Reading %s failed: the reader stopped '
+                                    '(exit code %s)' %
+                                    (self.sources[stopped],
+                                     getattr(readers[stopped], 'exitcode',
+                                             None)))
+                    if kind == 'batch':
+                        self.counts[index] += len(value)
+                        stage.items += len(value)
+                        self.converter.convert(value)
+                    elif kind == 'done':
+                        finished.add(index)
+                    else:
+                        raise RuntimeError('Reading %s failed:\n%s' %
+                                           (self.sources[index], value))
+        finally:
+            stop.set()
+            # A reader process cannot exit until the items it put on the
+            # queue have been flushed to it, so the queue is emptied until
+            # all of the readers have stopped
+            for reader in readers:
+                while reader.is_alive():
+                    _drain(queue)
+                    reader.join(0.1)
+        return self.converter.nodes
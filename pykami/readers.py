@@ -0,0 +1,78 @@
+"""Incremental readers for INDRA statement corpora.
+
+Statements are read lazily, so that corpora larger than memory can be
+converted: only the statements in the current batch need to be in memory.
+Two formats are supported:
+
+- pickle streams: files of concatenated pickles, each of which is either a
+  single statement or a list of statements (so that a monolithic pickle of
+  the whole statement list can be read too, albeit not incrementally);
+- JSONL: newline-delimited JSON, one statement per line, in INDRA's JSON
+  format.
+"""
+import json
+import pickle
+import itertools
+
+# File extensions of newline-delimited JSON files
+jsonl_extensions = ('.jsonl', '.ndjson')
+
+def batches(items, batch_size):
+    """Generate successive lists of batch_size items from any iterable."""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+        if not batch:
+            break
+        yield batch
+
+def read_pickle_stream(f):
+    """Generate the statements from a file of concatenated pickles."""
+    unpickler = pickle.Unpickler(f)
+    while True:
+        try:
+            obj = unpickler.load()
+        except EOFError:
+            break
+        if isinstance(obj, list):
+            for stmt in obj:
+                yield stmt
+        else:
+            yield obj
+
+def write_pickle_stream(stmts, f, batch_size=1000):
+    """Write statements as concatenated pickles of batch_size statements."""
+    for batch in batches(stmts, batch_size):
+        pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+def read_jsonl(f, from_json=None):
+    """Generate the statements from a newline-delimited JSON file.
+
+    Each line is deserialized with from_json, which defaults to
+    indra.statements.stmt_from_json. Blank lines are skipped.
+    """
+    if from_json is None:
+        import indra.statements
+        from_json = indra.statements.stmt_from_json
+    for line in f:
+        if line.strip():
+            yield from_json(json.loads(line))
+
+def read_statements(filename, from_json=None):
+    """Generate the statements in the file, read incrementally.
+
+    Files with a .jsonl or .ndjson extension are read as JSONL, any other
+    file as a pickle stream.
+    """
+    if filename.endswith(jsonl_extensions):
+        with open(filename) as f:
+            for stmt in read_jsonl(f, from_json):
+                yield stmt
+    else:
+        with open(filename, 'rb') as f:
+            for stmt in read_pickle_stream(f):
+                yield stmt
+
+def read_statement_batches(filename, batch_size=1000, from_json=None):
+    """Generate lists of batch_size statements read from the file."""
+    return batches(read_statements(filename, from_json), batch_size)
@@ -0,0 +1,434 @@
+"""Compact binary snapshots of converted Kami models.
+
+A snapshot stores the agents, sites, key residues, flags (with their
+formulas), attributes and relationships of a model in a binary file that can
+be opened through mmap: nothing is read until it is asked for, and records
+are decoded one at a time, so opening even a very large snapshot is
+immediate and looking up an agent only touches the pages holding it.
+
+The file consists of a header followed by five sections:
+
+- nodes: a fixed-size record for each node (see node_record). The nodes of
+  each agent are stored together, the agent first, followed by its
+  descendants in depth-first order. The relationships come after all of
+  the agents.
+- refs: an array of 32-bit integers referred to by the node records: the
+  formula terms of flags and attributes (as string indices), and the
+  endpoints of relationships (as node indices).
+- string offsets and string data: a table of the distinct names, formula
+  terms and non-numeric IDs, encoded in UTF-8.
+- agents: an index of the agents, sorted by name, for binary search.
+
+All numbers are little-endian.
+"""
+import sys
+import mmap
+import array
+import struct
+from core import Agent, Flag, Attribute, Phosphorylation, Bind
+from columnar import ColumnarGraph, AGENT, SITE, KEY_RESIDUE, FLAG, \
+                     ATTRIBUTE, PHOSPHORYLATION, type_names, type_code
+
+magic = 'PYKAMI\x00S'
+version = 1
+
+# Magic, version, and the numbers of nodes, refs, strings and agents, and of
+# the nodes of the agents (which come before the relationships)
+header = struct.Struct('<8sIIIIII')
+# The offsets of the sections following the header
+section_offsets = struct.Struct('<5Q')
+# The type, ID, parent index and name index of a node, followed by two
+# fields depending on its type: for components, the index of the end of
+# its subtree and 0; for flags and attributes, and relationships, the
+# start and length of its formula terms or endpoints in the refs
+node_record = struct.Struct('<qbxxxiiii')
+# The name index, node index and number of nodes of an agent
+agent_record = struct.Struct('<iii')
+string_offset = struct.Struct('<Q')
+
+def write_snapshot(nodes, f):
+    """Write a snapshot of the nodes to a file opened in binary mode.
+
+    Parameters
+    ----------
+    nodes : iterable of nodes, or columnar.ColumnarGraph
+        The agents and relationships to store (as for nodes_to_kami); the
+        sites, key residues, flags and attributes of the agents are stored
+        with them. The endpoints of the relationships must be contained in
+        the agents.
+    f : file
+        The file to write to.
+    """
+    if isinstance(nodes, ColumnarGraph):
+        nodes = [nodes.view(row) for row in xrange(len(nodes))]
+    strings = []
+    string_index = {}
+
+    def intern(string):
+        if string not in string_index:
+            string_index[string] = len(strings)
+            strings.append(string)
+        return string_index[string]
+
+    def encode_id(node_id):
+        # Numeric IDs are stored as they are, others as string indices
+        if isinstance(node_id, (int, long)) and node_id >= 0:
+            return node_id
+        return -1 - intern(str(node_id))
+
+    agents = []
+    relationships = []
+    for node in nodes:
+        node_type = type_code(node)
+        if node_type == AGENT:
+            agents.append(node)
+        elif node_type >= PHOSPHORYLATION:
+            relationships.append(node)
+    agents.sort(key=lambda agent: agent.name)
+
+    records = []
+    refs = array.array('i')
+    rows = {}
+    agent_index = []
+
+    def add_subtree(node, parent):
+        row = len(records)
+        rows[node] = row
+        node_type = type_code(node)
+        record = [encode_id(node.id), node_type, parent, intern(node.name),
+                  0, 0]
+        records.append(record)
+        if node_type == FLAG or node_type == ATTRIBUTE:
+            record[4] = len(refs)
+            for term in node.formula_terms:
+                refs.append(intern(term))
+            record[5] = len(refs) - record[4]
+        else:
+            for child in node.children():
+                add_subtree(child, row)
+            record[4] = len(records)
+
+    for agent in agents:
+        row = len(records)
+        add_subtree(agent, -1)
+        agent_index.append((intern(agent.name), row, len(records) - row))
+    for rel in relationships:
+        endpoints = rel.endpoints()
+        for endpoint in endpoints:
+            if endpoint not in rows:
+                raise ValueError('The endpoint %s of %s is not in the '
+                                 'snapshot' % (endpoint, rel.id))
+        records.append([encode_id(rel.id), type_code(rel), -1, -1,
+                        len(refs), len(endpoints)])
+        for endpoint in endpoints:
+            refs.append(rows[endpoint])
+    # The names are sorted by their encoded bytes, for the binary search
+    encoded = [string.encode('utf-8') if isinstance(string, unicode)
+               else string for string in strings]
+    agent_index.sort(key=lambda entry: encoded[entry[0]])
+    if sys.byteorder == 'big':
+        refs.byteswap()
+
+    offsets = []
+    position = header.size + section_offsets.size
+    sizes = [node_record.size * len(records), refs.itemsize * len(refs),
+             string_offset.size * (len(strings) + 1),
+             sum(len(string) for string in encoded)]
+    for size in sizes:
+        offsets.append(position)
+        position += size
+    offsets.append(position)
+    f.write(header.pack(magic, version, len(records), len(refs),
+                        len(strings), len(agent_index),
+                        len(records) - len(relationships)))
+    f.write(section_offsets.pack(*offsets))
+    for record in records:
+        f.write(node_record.pack(*record))
+    f.write(refs.tostring())
+    position = 0
+    for string in encoded:
+        f.write(string_offset.pack(position))
+        position += len(string)
+    f.write(string_offset.pack(position))
+    for string in encoded:
+        f.write(string)
+    for entry in agent_index:
+        f.write(agent_record.pack(*entry))
+
+
+class Snapshot(object):
+    """A snapshot file opened through mmap, with lazily decoded records.
+
+    Parameters
+    ----------
+    filename : string
+        The name of the snapshot file, as written by write_snapshot.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (file_magic, file_version, self.num_nodes, self.num_refs,
+         self.num_strings, self.num_agents, self._relationships_start) = \
+                header.unpack_from(self.buffer)
+        if file_magic != magic or file_version != version:
+            raise ValueError('%s is not a snapshot (version %d)' %
+                             (filename, version))
+        (self._nodes_offset, self._refs_offset, self._string_offsets_offset,
+         self._strings_offset, self._agents_offset) = \
+                section_offsets.unpack_from(self.buffer, header.size)
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.num_nodes
+
+    def string(self, index):
+        """Return the string with the given index in the string table."""
+        start, end = struct.unpack_from('<2Q', self.buffer,
+                                        self._string_offsets_offset +
+                                        index * string_offset.size)
+        string = self.buffer[self._strings_offset + start:
+                             self._strings_offset + end]
+        # ASCII strings are returned as str, like the names they came from
+        try:
+            return str(string.decode('ascii'))
+        except UnicodeDecodeError:
+            return string.decode('utf-8')
+
+    def record(self, row):
+        """Return the decoded record of the node in the row (see
+        node_record)."""
+        return node_record.unpack_from(self.buffer, self._nodes_offset +
+                                                    row * node_record.size)
+
+    def refs(self, start, length):
+        """Return a list of integers from the refs."""
+        return list(struct.unpack_from('<%di' % length, self.buffer,
+                                       self._refs_offset + start * 4))
+
+    def decode_id(self, code):
+        return code if code >= 0 else self.string(-1 - code)
+
+    def node(self, row):
+        """Return a view of the node in the row."""
+        return SnapshotNode(self, row)
+
+    def agent_entry(self, i):
+        """Return the (name index, row, number of nodes) of the i-th agent
+        in the index (in order of name)."""
+        return agent_record.unpack_from(self.buffer, self._agents_offset +
+                                                     i * agent_record.size)
+
+    def agent_names(self):
+        """Generate the names of the agents, in sorted order."""
+        for i in xrange(self.num_agents):
+            yield self.string(self.agent_entry(i)[0])
+
+    def agent(self, name):
+        """Return a view of the agent with the given name.
+
+        The agent is found by binary search of the index, decoding only the
+        names compared. Raises KeyError if there is no such agent.
+        """
+        key = name.encode('utf-8') if isinstance(name, unicode) else name
+        low, high = 0, self.num_agents
+        while low < high:
+            middle = (low + high) // 2
+            name_index, row, _ = self.agent_entry(middle)
+            middle_name = self.string(name_index)
+            if isinstance(middle_name, unicode):
+                middle_name = middle_name.encode('utf-8')
+            if middle_name < key:
+                low = middle + 1
+            elif middle_name > key:
+                high = middle
+            else:
+                return self.node(row)
+        raise KeyError(name)
+
+    def agents(self):
+        """Generate views of all of the agents, in order of name."""
+        for i in xrange(self.num_agents):
+            yield self.node(self.agent_entry(i)[1])
+
+    def relationships(self):
+        """Generate views of all of the relationships."""
+        for row in xrange(self._relationships_start, self.num_nodes):
+            yield self.node(row)
+
+    def load_nodes(self, agent_names=None):
+        """Build core nodes for the agents and the relationships between
+        them, with the IDs stored in the snapshot.
+
+        Parameters
+        ----------
+        agent_names : list of string
+            The names of the agents to load; if not given, all of the
+            agents are loaded.
+
+        Returns a list of the agents, all of their descendants and the
+        relationships, which can be passed to nodes_to_kami or Graph.
+        """
+        if agent_names is None:
+            agents = list(self.agents())
+        else:
+            agents = [self.agent(name) for name in agent_names]
+        nodes = []
+        core_nodes = {}
+
+        def load(view, parent):
+            node_type = view.node_type
+            if node_type == AGENT:
+                node = Agent(view.name)
+            elif node_type == SITE:
+                node = parent.get_create_site(view.name)
+            elif node_type == KEY_RESIDUE:
+                node = parent.get_create_key_residue(view.name)
+            elif node_type == FLAG:
+                node = parent.get_create_flag(view.name)
+            else:
+                node = parent.get_create_attribute(view.name)
+            node.id = view.id
+            for term in view.formula_terms:
+                node.add_formula_term(term)
+            core_nodes[view.row] = node
+            nodes.append(node)
+            for child in view.children():
+                load(child, node)
+
+        for agent in agents:
+            load(agent, None)
+        for rel in self.relationships():
+            endpoint_rows = self.refs(*rel.record[4:6])
+            if not all(row in core_nodes for row in endpoint_rows):
+                continue
+            endpoints = [core_nodes[row] for row in endpoint_rows]
+            if rel.node_type == PHOSPHORYLATION:
+                node = Phosphorylation(*endpoints)
+            else:
+                node = Bind(*endpoints)
+            node.id = rel.id
+            nodes.append(node)
+        return nodes
+
+
+class SnapshotNode(object):
+    """View of a node in a Snapshot, decoding its record on first use.
+
+    Parameters
+    ----------
+    snapshot : Snapshot
+        The snapshot containing the node.
+    row : int
+        The index of the node in the snapshot.
+    """
+    __slots__ = ('snapshot', 'row', '_record')
+
+    def __init__(self, snapshot, row):
+        self.snapshot = snapshot
+        self.row = row
+        self._record = None
+
+    @property
+    def record(self):
+        if self._record is None:
+            self._record = self.snapshot.record(self.row)
+        return self._record
+
+    @property
+    def node_type(self):
+        return self.record[1]
+
+    @property
+    def id(self):
+        return self.snapshot.decode_id(self.record[0])
+
+    @property
+    def name(self):
+        name = self.record[3]
+        return self.snapshot.string(name) if name >= 0 else self.id
+
+    @property
+    def parent(self):
+        parent = self.record[2]
+        return self.snapshot.node(parent) if parent >= 0 else None
+
+    @property
+    def path(self):
+        path = []
+        node = self
+        while node is not None:
+            path.append(node.id)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def children(self):
+        """Return views of the nodes whose parent is this node."""
+        if self.node_type not in (AGENT, SITE, KEY_RESIDUE):
+            return []
+        children = []
+        row = self.row + 1
+        end = self.record[4]
+        # Skip over the subtree of each child to get to the next one
+        while row < end:
+            child = self.snapshot.node(row)
+            children.append(child)
+            if child.node_type in (AGENT, SITE, KEY_RESIDUE):
+                row = child.record[4]
+            else:
+                row += 1
+        return children
+
+    def _children_dict(self, node_type):
+        return dict((child.name, child) for child in self.children()
+                    if child.node_type == node_type)
+
+    @property
+    def sites(self):
+        return self._children_dict(SITE)
+
+    @property
+    def key_residues(self):
+        return self._children_dict(KEY_RESIDUE)
+
+    @property
+    def flags(self):
+        return self._children_dict(FLAG)
+
+    @property
+    def attributes(self):
+        return self._children_dict(ATTRIBUTE)
+
+    @property
+    def formula_terms(self):
+        """The sequence of distinct terms of the formula."""
+        if self.node_type not in (FLAG, ATTRIBUTE):
+            return []
+        return [self.snapshot.string(term)
+                for term in self.snapshot.refs(*self.record[4:6])]
+
+    @property
+    def formula(self):
+        terms = self.formula_terms
+        if not terms:
+            return None
+        cls = Attribute if self.node_type == ATTRIBUTE else Flag
+        return cls.formula_separator.join(terms)
+
+    def endpoints(self):
+        """Return views of the nodes connected by a relationship."""
+        if self.node_type < PHOSPHORYLATION:
+            return []
+        return [self.snapshot.node(row)
+                for row in self.snapshot.refs(*self.record[4:6])]
+
+    def __str__(self):
+        return ("%s(%s)" % (type_names[self.node_type], self.name))
@@ -0,0 +1,85 @@
+"""Hand-made statements for the tests.
+
+The classes have the names and the fields of the INDRA statements used by
+IndraKamiConverter (whose handlers are looked up by the name of the type of
+statement), so that the tests do not need INDRA.
+"""
+import os
+import sys
+import json
+import random
+
+# The pykami modules use implicit relative imports, so the package directory
+# itself has to be on the path
+pykami_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'pykami')
+sys.path.insert(0, pykami_dir)
+
+from core import Flag
+
+mods = ['Phosphorylation', 'PhosphorylationTyrosine', 'PhosphorylationSerine',
+        'PhosphorylationThreonine']
+
+
+class Agent(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Phosphorylation(object):
+    def __init__(self, enz, sub, mod, mod_pos):
+        self.enz = Agent(enz)
+        self.sub = Agent(sub)
+        self.mod = mod
+        self.mod_pos = mod_pos
+
+
+class ActivityModification(object):
+    def __init__(self, monomer, mod, mod_pos, relationship, activity):
+        self.monomer = Agent(monomer)
+        self.mod = mod
+        self.mod_pos = mod_pos
+        self.relationship = relationship
+        self.activity = activity
+
+
+class Complex(object):
+    """A type of statement without a handler."""
+
+def make_statements(num_stmts, num_agents=20, seed=0):
+    """Return a list of random statements between num_agents agents."""
+    rng = random.Random(seed)
+    names = ['A%d' % i for i in range(num_agents)]
+    stmts = []
+    for _ in range(num_stmts):
+        choice = rng.random()
+        if choice < 0.6:
+            stmts.append(Phosphorylation(rng.choice(names), rng.choice(names),
+                                         rng.choice(mods),
+                                         rng.choice([None, '202', '204'])))
+        elif choice < 0.95:
+            num_mods = rng.choice([1, 2])
+            stmts.append(ActivityModification(
+                            rng.choice(names),
+                            [rng.choice(mods[1:]) for _ in range(num_mods)],
+                            [rng.choice(['202', '204', '0218'])
+                             for _ in range(num_mods)],
+                            rng.choice(['directlyIncreases',
+                                        'directlyDecreases']),
+                            rng.choice(['Kinase', 'Gtpase'])))
+        else:
+            stmts.append(Complex())
+    return stmts
+
+def normalized(output):
+    """Return a Kami JSON dict with the records of each section sorted, to
+    compare documents regardless of the order of the records."""
+    return dict((section, sorted(json.dumps(record, sort_keys=True)
+                                 for record in records))
+                for section, records in output.iteritems())
+
+def formulas(nodes):
+    """Return the formulas of the flags and attributes among the nodes, by
+    ID (formulas are not part of the Kami JSON)."""
+    return dict((node.id, node.formula) for node in nodes
+                if isinstance(node, Flag))
@@ -0,0 +1,60 @@
+"""Tests of the conversion of models into an agent_registry.
+
+Usage: python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from statements import make_statements, normalized, formulas
+
+import core
+from agent_registry import DiskAgentRegistry
+from indra_to_kami import IndraKamiConverter, nodes_to_kami
+
+
+class TestDiskAgentRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'registry.db')
+        self.stmts = make_statements(1000)
+        core.id_counter = 0
+        self.ikc = IndraKamiConverter()
+        self.ikc.convert(self.stmts)
+        self.expected = normalized(nodes_to_kami(self.ikc.nodes))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, stmts, cache_size):
+        """Convert the statements into the registry file, returning the
+        records and formulas of the model stored in it."""
+        registry = DiskAgentRegistry(self.filename, cache_size)
+        try:
+            ikc = IndraKamiConverter(registry=registry)
+            ikc.convert(stmts)
+            return (normalized(nodes_to_kami(ikc.nodes)),
+                    formulas(ikc.nodes))
+        finally:
+            registry.close()
+
+    def test_export(self):
+        # The cache holds few of the agents, so that they are written to
+        # and loaded from the database as they are converted
+        core.id_counter = 0
+        output, model_formulas = self.convert(self.stmts, 2)
+        self.assertEqual(output, self.expected)
+        self.assertEqual(model_formulas, formulas(self.ikc.nodes))
+
+    def test_reopen(self):
+        # The model converted in two runs is that of a single one
+        core.id_counter = 0
+        self.convert(self.stmts[:500], 2)
+        core.id_counter = 0
+        output, model_formulas = self.convert(self.stmts[500:], 2)
+        self.assertEqual(output, self.expected)
+        self.assertEqual(model_formulas, formulas(self.ikc.nodes))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+"""Tests of the dicts of children of core.Component.
+
+Usage: python -m unittest discover tests
+"""
+import pickle
+import unittest
+
+import statements
+from core import Agent, Flag, Site
+
+
+class TestChildren(unittest.TestCase):
+    def test_empty(self):
+        agent = Agent('A')
+        self.assertEqual(agent.flags, {})
+        self.assertEqual(agent.children(), [])
+
+    def test_store(self):
+        agent = Agent('A')
+        flag = Flag('active', agent, None)
+        agent.flags['active'] = flag
+        site = agent.sites.setdefault('S', Site('S', agent))
+        agent.attributes.update(length=1)
+        self.assertIs(agent.flags['active'], flag)
+        self.assertIs(agent.sites['S'], site)
+        self.assertEqual(agent.attributes, {'length': 1})
+        self.assertEqual(agent.key_residues, {})
+
+    def test_pickle(self):
+        agent = Agent('A')
+        agent.flags['active'] = Flag('active', agent, None)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(agent, protocol))
+            self.assertEqual(copy.flags.keys(), ['active'])
+            self.assertIs(copy.flags['active'].parent, copy)
+
+if __name__ == '__main__':
+    unittest.main()
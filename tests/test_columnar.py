@@ -0,0 +1,54 @@
+"""Tests of the export of models built in a columnar.ColumnarGraph.
+
+Usage: python -m unittest discover tests
+"""
+import json
+import unittest
+import StringIO
+
+from statements import make_statements, normalized
+
+import core
+from columnar import ColumnarGraph
+from indra_to_kami import IndraKamiConverter, nodes_to_kami, write_kami, \
+                          KamiExport
+
+
+class TestColumnarExport(unittest.TestCase):
+    def setUp(self):
+        self.stmts = make_statements(300)
+        core.id_counter = 0
+        self.ikc = IndraKamiConverter(store=ColumnarGraph())
+        self.ikc.convert(self.stmts)
+
+    def test_store(self):
+        # The model exported from the store is that of the core nodes
+        output = nodes_to_kami(self.ikc.store)
+        core.id_counter = 0
+        ikc = IndraKamiConverter()
+        ikc.convert(self.stmts)
+        self.assertEqual(normalized(output),
+                         normalized(nodes_to_kami(ikc.nodes)))
+
+    def test_views(self):
+        # The views of the rows are exported as the store itself
+        output = nodes_to_kami(self.ikc.store)
+        self.assertTrue(output['agents'])
+        self.assertEqual(normalized(nodes_to_kami(self.ikc.nodes)),
+                         normalized(output))
+        self.assertEqual(normalized(nodes_to_kami(iter(self.ikc.nodes))),
+                         normalized(output))
+        f = StringIO.StringIO()
+        write_kami(self.ikc.nodes, f)
+        self.assertEqual(normalized(json.loads(f.getvalue())),
+                         normalized(output))
+        self.assertEqual(normalized(KamiExport(self.ikc.nodes).to_dict()),
+                         normalized(output))
+
+    def test_render_views(self):
+        graph = core.Graph('columnar', self.ikc.nodes)
+        with self.assertRaises(TypeError):
+            graph.write_dot(StringIO.StringIO())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Tests of the conversion of statements with a conversion_cache.
+
+Usage: python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from statements import make_statements, normalized, formulas
+
+import core
+from conversion_cache import ConversionCache
+from indra_to_kami import IndraKamiConverter, nodes_to_kami
+
+
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'cache.db')
+        self.stmts = make_statements(1000)
+        core.id_counter = 0
+        self.ikc = IndraKamiConverter()
+        self.ikc.convert(self.stmts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert_cached(self):
+        core.id_counter = 0
+        cache = ConversionCache(self.filename)
+        try:
+            ikc = IndraKamiConverter(cache=cache)
+            ikc.convert(self.stmts)
+        finally:
+            cache.close()
+        self.assertEqual(normalized(nodes_to_kami(ikc.nodes)),
+                         normalized(nodes_to_kami(self.ikc.nodes)))
+        self.assertEqual(formulas(ikc.nodes), formulas(self.ikc.nodes))
+        return cache
+
+    def test_replay(self):
+        # The first conversion fills the cache (replaying the statements
+        # seen before), and the second replays all of the statements
+        cache = self.convert_cached()
+        self.assertTrue(cache.misses)
+        cache = self.convert_cached()
+        self.assertEqual(cache.misses, 0)
+        self.assertTrue(cache.hits)
+
+if __name__ == '__main__':
+    unittest.main()
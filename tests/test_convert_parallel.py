@@ -0,0 +1,29 @@
+"""Tests of IndraKamiConverter.convert_parallel.
+
+Usage: python -m unittest discover tests
+"""
+import unittest
+
+from statements import make_statements, normalized, formulas
+
+import core
+from indra_to_kami import IndraKamiConverter, nodes_to_kami
+
+
+class TestConvertParallel(unittest.TestCase):
+    def test_serial(self):
+        # Each worker converts several shards, and the nodes of the later
+        # shards are merged into those of the earlier ones
+        stmts = make_statements(2000)
+        core.id_counter = 0
+        serial = IndraKamiConverter()
+        serial.convert(stmts)
+        core.id_counter = 0
+        parallel = IndraKamiConverter()
+        parallel.convert_parallel(stmts, processes=2, shard_size=170)
+        self.assertEqual(normalized(nodes_to_kami(parallel.nodes)),
+                         normalized(nodes_to_kami(serial.nodes)))
+        self.assertEqual(formulas(parallel.nodes), formulas(serial.nodes))
+
+if __name__ == '__main__':
+    unittest.main()
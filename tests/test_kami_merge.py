@@ -0,0 +1,117 @@
+"""Tests of the merge of Kami JSON documents with kami_merge.
+
+Usage: python -m unittest discover tests
+"""
+import json
+import unittest
+
+from statements import make_statements
+
+import core
+from kami_merge import merge_kami
+from indra_to_kami import IndraKamiConverter, nodes_to_kami
+
+
+def references(document):
+    """Generate the IDs referred to by the records of a Kami JSON document.
+    """
+    for record in document['regions'] + document['key_rs']:
+        yield record['ag_name']
+    for record in document['flags'] + document['attributes']:
+        for node_id in record['dest_path']:
+            yield node_id
+    for record in document['actions']:
+        for element in record['context']:
+            for node_id in element['el_path']:
+                yield node_id
+    for record in document['actions_binder']:
+        yield record['act_name']
+    for record in document['edges']:
+        yield record['in_path'][0]
+        for node_id in record['out_path']:
+            yield node_id
+
+def canonical(document):
+    """Return the distinct records of each section of a Kami JSON document
+    (as JSON strings), with the IDs replaced by keys made of the labels of
+    the records, so that documents can be compared regardless of their IDs.
+    """
+    keys = {}
+
+    def path_key(path):
+        return [keys[node_id] for node_id in path]
+
+    def context(record):
+        return [dict(element, el_path=path_key(element['el_path']))
+                for element in record['context']]
+
+    for record in document['agents']:
+        keys[record['name']] = ['agent', record['label']]
+    for record in document['regions']:
+        keys[record['name']] = [keys[record['ag_name']], record['label']]
+    for section in ('flags', 'attributes'):
+        for record in document[section]:
+            keys[record['name']] = [path_key(record['dest_path']),
+                                    record['label']]
+    for record in document['actions']:
+        keys[record['name']] = ['action', context(record)]
+
+    output = {}
+    for section, records in document.iteritems():
+        output[section] = set([])
+        for record in records:
+            record = dict(record)
+            # The names of binders are not IDs
+            if 'name' in record and section != 'actions_binder':
+                record['name'] = keys[record['name']]
+            if section == 'regions':
+                record['ag_name'] = keys[record['ag_name']]
+            elif section in ('flags', 'attributes'):
+                record['dest_path'] = path_key(record['dest_path'])
+            elif section == 'actions':
+                # The labels of actions are their IDs
+                record['label'] = keys[record['label']]
+                record['context'] = context(record)
+            elif section == 'actions_binder':
+                record['act_name'] = keys[record['act_name']]
+            elif section == 'edges':
+                record['in_path'] = [keys[record['in_path'][0]]] + \
+                                    record['in_path'][1:]
+                record['out_path'] = path_key(record['out_path'])
+            output[section].add(json.dumps(record, sort_keys=True))
+    return output
+
+def convert(stmts):
+    """Return the Kami JSON document of the statements, as read back from a
+    file."""
+    # Every document starts with the same IDs, so the IDs of the shards
+    # collide
+    core.id_counter = 0
+    ikc = IndraKamiConverter()
+    ikc.convert(stmts)
+    return json.loads(json.dumps(nodes_to_kami(ikc.nodes)))
+
+
+class TestKamiMerge(unittest.TestCase):
+    def setUp(self):
+        stmts = make_statements(900)
+        self.shards = [convert(stmts[start:start + 300])
+                       for start in range(0, len(stmts), 300)]
+        self.whole = convert(stmts)
+        self.merged = merge_kami(self.shards)
+
+    def test_references(self):
+        ids = [record['name'] for section, records in self.merged.iteritems()
+               if section not in ('infos', 'actions_binder', 'edges')
+               for record in records]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertTrue(set(references(self.merged)) <= set(ids))
+
+    def test_whole(self):
+        # Merging the shards gives the document of the whole corpus, except
+        # that the merge unifies the actions with the same endpoints, which
+        # the converter creates for each statement
+        self.assertEqual(canonical(self.merged), canonical(self.whole))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+"""Tests of the packing of laid out graphs by core.pack_dot.
+
+Usage: python -m unittest discover tests
+"""
+import unittest
+
+import statements
+from core import _translate_points
+
+
+class TestTranslatePoints(unittest.TestCase):
+    def test_points(self):
+        self.assertEqual(_translate_points('27,18 99.5,36.25!', 10, 0.5),
+                         '37,18.5 109.5,36.75!')
+
+    def test_spline(self):
+        self.assertEqual(_translate_points('e,10,20 1,2 3,4', 1, 1),
+                         'e,11,21 2,3 4,5')
+
+    def test_large(self):
+        # Packed rows of components reach coordinates in the millions
+        self.assertEqual(_translate_points('1234567.25,7654321', 1, 0.5),
+                         '1234568.25,7654321.5')
+
+if __name__ == '__main__':
+    unittest.main()
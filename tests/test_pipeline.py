@@ -0,0 +1,73 @@
+"""Tests of the error handling of pipeline.IngestionPipeline.
+
+Usage: python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import signal
+import unittest
+
+# The pykami modules use implicit relative imports, so the package directory
+# itself has to be on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'pykami'))
+
+from pipeline import IngestionPipeline
+
+
+class Statement(object):
+    """A statement of a type without a handler, ignored by the converter."""
+    def __init__(self):
+        self.evidence = 'x' * 100
+
+def many_statements():
+    """A source of more statements than the queue (and the pipes of reader
+    processes) can hold."""
+    for _ in xrange(200000):
+        yield Statement()
+
+def failing_source():
+    """A source failing after the other has started filling the queue."""
+    time.sleep(0.5)
+    raise IOError('Cannot read source')
+
+def exiting_source():
+    """A source whose reader process exits without reporting an error."""
+    time.sleep(0.5)
+    os._exit(1)
+
+def _timeout(signum, frame):
+    raise AssertionError('The pipeline did not stop')
+
+
+class TestReaderErrors(unittest.TestCase):
+    def setUp(self):
+        self.previous_handler = signal.signal(signal.SIGALRM, _timeout)
+        signal.alarm(30)
+
+    def tearDown(self):
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, self.previous_handler)
+
+    def check_error(self, processes):
+        pipeline = IngestionPipeline([many_statements, failing_source],
+                                     processes=processes)
+        with self.assertRaises(RuntimeError) as context:
+            pipeline.run()
+        self.assertIn('Cannot read source', str(context.exception))
+
+    def test_error_processes(self):
+        self.check_error(True)
+
+    def test_error_threads(self):
+        self.check_error(False)
+
+    def test_reader_exit(self):
+        pipeline = IngestionPipeline([many_statements, exiting_source])
+        with self.assertRaises(RuntimeError) as context:
+            pipeline.run()
+        self.assertIn('exiting_source', str(context.exception))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Tests of the round trip of models through snapshot files.
+
+Usage: python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from statements import make_statements, normalized, formulas
+
+from columnar import ColumnarGraph
+from snapshot import Snapshot, write_snapshot
+from indra_to_kami import IndraKamiConverter, KamiExport, nodes_to_kami
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'model.snapshot')
+        self.stmts = make_statements(500)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def load_nodes(self, nodes, agent_names=None):
+        with open(self.filename, 'wb') as f:
+            write_snapshot(nodes, f)
+        with Snapshot(self.filename) as snapshot:
+            return snapshot.load_nodes(agent_names)
+
+    def test_round_trip(self):
+        ikc = IndraKamiConverter()
+        ikc.convert(self.stmts)
+        nodes = self.load_nodes(ikc.nodes)
+        self.assertEqual(normalized(nodes_to_kami(nodes)),
+                         normalized(nodes_to_kami(ikc.nodes)))
+        self.assertEqual(formulas(nodes), formulas(ikc.nodes))
+
+    def test_store(self):
+        ikc = IndraKamiConverter(store=ColumnarGraph())
+        ikc.convert(self.stmts)
+        nodes = self.load_nodes(ikc.store)
+        self.assertEqual(normalized(nodes_to_kami(nodes)),
+                         normalized(nodes_to_kami(ikc.store)))
+
+    def test_agents(self):
+        # Loading some of the agents gives the relationships between them
+        ikc = IndraKamiConverter()
+        ikc.convert(self.stmts)
+        agents = ['A1', 'A2', 'A3']
+        nodes = self.load_nodes(ikc.nodes, agents)
+        expected = KamiExport(ikc.nodes, agents=agents).to_dict()
+        self.assertTrue(expected['actions'])
+        self.assertEqual(normalized(nodes_to_kami(nodes)),
+                         normalized(expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Tests of the reproducibility of exports with stable IDs.
+
+Usage: python -m unittest discover tests
+"""
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from statements import make_statements
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Runs indra_to_kami.main in a new interpreter, with the hand-made statement
+# classes importable to unpickle the statements
+convert_code = ('import sys; sys.path.insert(0, %r); import statements, '
+                'indra_to_kami; sys.exit(indra_to_kami.main(sys.argv[1:]))' %
+                tests_dir)
+
+
+class TestStableExports(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stmts_file = os.path.join(self.tmp_dir, 'statements.pck')
+        with open(self.stmts_file, 'wb') as f:
+            pickle.dump(make_statements(500), f, pickle.HIGHEST_PROTOCOL)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, *options):
+        """Convert the statements in a new process, returning the output."""
+        output_file = os.path.join(self.tmp_dir, 'kami.json')
+        subprocess.check_call([sys.executable, '-c', convert_code,
+                               '--stable-ids', '-o', output_file] +
+                              list(options) + [self.stmts_file])
+        with open(output_file) as f:
+            return f.read()
+
+    def test_serial(self):
+        self.assertEqual(self.convert(), self.convert())
+
+    def test_parallel(self):
+        self.assertEqual(self.convert('-p', '2'), self.convert('-p', '2'))
+
+if __name__ == '__main__':
+    unittest.main()
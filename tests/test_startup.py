@@ -0,0 +1,28 @@
+"""Tests of the modules loaded on importing indra_to_kami.
+
+Usage: python -m unittest discover tests
+"""
+import sys
+import unittest
+import subprocess
+
+from statements import pykami_dir
+
+# The top-level packages of the modules only needed by some of the jobs
+heavy_modules = ('pygraphviz', 'indra', 'sqlite3')
+
+
+class TestStartup(unittest.TestCase):
+    def test_import(self):
+        # The modules are listed in a new interpreter, as the tests import
+        # some of them
+        code = ('import sys; import indra_to_kami; '
+                'print "\\n".join(m for m in sys.modules '
+                'if m.split(".")[0] in %r and sys.modules[m] is not None)' %
+                (heavy_modules,))
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=pykami_dir)
+        self.assertEqual(output.split(), [])
+
+if __name__ == '__main__':
+    unittest.main()
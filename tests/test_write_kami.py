@@ -0,0 +1,37 @@
+"""Tests of indra_to_kami.write_kami.
+
+Usage: python -m unittest discover tests
+"""
+import json
+import unittest
+import StringIO
+
+from statements import make_statements
+
+from columnar import ColumnarGraph
+from indra_to_kami import IndraKamiConverter, nodes_to_kami, write_kami
+
+
+class TestWriteKami(unittest.TestCase):
+    def check_output(self, nodes):
+        # The streamed text is exactly that of the document built in memory
+        f = StringIO.StringIO()
+        write_kami(nodes, f)
+        self.assertEqual(f.getvalue(),
+                         json.dumps(nodes_to_kami(nodes), indent=2))
+
+    def test_nodes(self):
+        ikc = IndraKamiConverter()
+        ikc.convert(make_statements(300))
+        self.check_output(ikc.nodes)
+
+    def test_store(self):
+        ikc = IndraKamiConverter(store=ColumnarGraph())
+        ikc.convert(make_statements(300))
+        self.check_output(ikc.store)
+
+    def test_empty(self):
+        self.check_output([])
+
+if __name__ == '__main__':
+    unittest.main()